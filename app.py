@@ -1,30 +1,121 @@
 """Blogly application."""
 
-from flask import Flask, request, render_template, redirect
-from models import db, connect_db, User, Post, Tag, PostTag
-from flask_debugtoolbar import DebugToolbarExtension
-from werkzeug.exceptions import HTTPException
-
-app = Flask(__name__)
-app.config['SQLALCHEMY_DATABASE_URI'] = 'postgresql:///blogly'
-app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
-app.config['SQLALCHEMY_ECHO'] = True
-app.config['SECRET_KEY'] = "SECRET!"
-app.config['DEBUG_TB_INTERCEPT_REDIRECTS'] = False
-debug = DebugToolbarExtension(app)
-
-connect_db(app)
-db.create_all()
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from flask import (Flask, Blueprint, current_app, request, render_template, redirect, jsonify,
+                   flash, make_response, Response, stream_with_context)
+import click
+from datetime import datetime
+from sqlalchemy.orm import joinedload, selectinload, load_only
+from config import PROFILES
+from models import db, connect_db, User, Post, Tag, PostTag, RelatedPost, CacheVersion, tag_catalog
+from pagination import keyset_paginate
+from cache import fragment_cache, post_key, user_key, tag_key
+from search import search_posts, reindex_all
+from export import export_chunks, KINDS, FORMATS
+from importer import import_files
+from benchmark import bench
+from instrumentation import metrics
+from purge import purge, purge_worker
+from werkzeug.exceptions import HTTPException, BadRequest, NotFound
+from werkzeug.http import is_resource_modified
+
+bp = Blueprint("blogly", __name__, cli_group=None)
+
+
+def create_app(config=None):
+    """Build the app for a profile name from config.PROFILES or a config class,
+    defaulting to $BLOGLY_CONFIG or development. Nothing touches the
+    database here; run `flask init-db` to create the schema."""
+
+    if config is None:
+        config = os.environ.get("BLOGLY_CONFIG", "development")
+
+    if isinstance(config, str):
+        config = PROFILES[config]
+
+    app = Flask(__name__)
+    app.config.from_object(config)
+
+    connect_db(app)
+    fragment_cache.init_app(app)
+    metrics.init_app(app)
+
+    if app.config["DEBUG_TB_ENABLED"]:
+        from flask_debugtoolbar import DebugToolbarExtension
+        DebugToolbarExtension(app)
+
+    app.register_blueprint(bp)
+    app.cli.add_command(bench)
+
+    return app
+
+def page_size(config_key, args=None):
+    """Page size from ?per_page=, defaulting to config_key and capped at MAX_PER_PAGE.
+    args defaults to request.args."""
+
+    args = request.args if args is None else args
+    per_page = args.get("per_page", current_app.config[config_key], type=int)
+
+    return max(1, min(per_page, current_app.config['MAX_PER_PAGE']))
+
+# ?sort= choices for list pages: (sort-key columns, descending). Each has an index.
+USER_ORDERS = {"name": ((User.last_name, User.first_name, User.id), False),
+               "posts": ((User.post_count, User.id), True)}
+TAG_ORDERS = {"name": ((Tag.name, Tag.id), False),
+              "posts": ((Tag.post_count, Tag.id), True)}
+
+def list_order(orders, args=None):
+    """(sort, columns, descending) for ?sort=, defaulting to name.
+    args defaults to request.args."""
+
+    args = request.args if args is None else args
+    sort = args.get("sort", "name")
+
+    if sort not in orders:
+        raise BadRequest(f"sort must be one of {', '.join(orders)}")
+
+    return (sort,) + orders[sort]
+
+def page_etag(model, id, updated_at):
+    return (f"{model.__tablename__}-{id}-{updated_at:%Y%m%d%H%M%S%f}-"
+            f"{current_app.config['ETAG_VERSION']}")
+
+def conditional(model, id, render):
+    """Respond with render(etag) plus ETag and Last-Modified taken from the
+    row's updated_at, or with a bare 304 when the client's copy is still
+    current. Only the primary-key lookup of updated_at runs for a 304.
+    render gets the ETag so that cached pages can be keyed on it."""
+
+    updated_at = db.session.query(model.updated_at).filter_by(id=id).scalar()
+
+    if updated_at is None:
+        raise NotFound()
+
+    etag = page_etag(model, id, updated_at)
+
+    if not is_resource_modified(request.environ, etag, last_modified=updated_at):
+        response = Response(status=304)
+    else:
+        response = make_response(render(etag))
+
+    response.set_etag(etag)
+    response.last_modified = updated_at
+    response.cache_control.no_cache = True
+
+    return response
 
 # Create
 
-@app.route('/users/new', methods=['GET'])
+@bp.route('/users/new', methods=['GET'])
 def user_form():
     """Show user form"""
 
     return render_template("new_user.html")
 
-@app.route('/users/new', methods=['POST'])
+@bp.route('/users/new', methods=['POST'])
 def submit_user_form():
     """submit user form"""
 
@@ -38,16 +129,15 @@ def submit_user_form():
 
     return redirect('/users')
 
-@app.route('/users/<int:id>/posts/new', methods=['GET'])
+@bp.route('/users/<int:id>/posts/new', methods=['GET'])
 def post_form(id):
     """Show form to add a post for user whose id=id"""
 
     user = User.query.get_or_404(id)
-    tags = Tag.query.all()
 
-    return render_template('new_post.html', user=user, tags=tags)
+    return render_template('new_post.html', user=user)
 
-@app.route('/users/<int:id>/posts/new', methods=['POST'])
+@bp.route('/users/<int:id>/posts/new', methods=['POST'])
 def post_form_submit(id):
     """Handle new post submission"""
 
@@ -55,21 +145,40 @@ def post_form_submit(id):
     content = request.form["content"]
     tags = request.form.getlist("tags")
 
-    new_post = Post(title=title, content=content, user_id=id)
-    db.session.add(new_post)
-    db.session.commit()
-
-    PostTag.add_tags(new_post.id, tags)
+    User.query.options(load_only(User.id)).get_or_404(id)
+    Post.create(id, title, content, tags)
 
     return redirect(f"/users/{id}")
 
-@app.route('/tags/new', methods=['GET'])
+@bp.route('/api/posts', methods=['POST'])
+def create_posts_json():
+    """Create a batch of posts with their tags in one transaction.
+    Takes {"posts": [{"user_id", "title", "content", "tags": [tag ids]}, ...]}
+    and answers 201 with the new ids, or 422 with per-item errors and nothing written."""
+
+    data = request.get_json(silent=True)
+    items = data.get("posts") if isinstance(data, dict) else None
+
+    if not isinstance(items, list) or not items:
+        return jsonify(error='Expected {"posts": [...]} with at least one post'), 400
+
+    if len(items) > current_app.config['MAX_BATCH_POSTS']:
+        return jsonify(error=f"At most {current_app.config['MAX_BATCH_POSTS']} posts per batch"), 413
+
+    ids, errors = Post.create_many(items)
+
+    if errors:
+        return jsonify(errors=errors), 422
+
+    return jsonify(ids=ids), 201
+
+@bp.route('/tags/new', methods=['GET'])
 def new_tag():
     """Display new tag form"""
 
     return render_template('new_tag.html')
 
-@app.route('/tags/new', methods=['POST'])
+@bp.route('/tags/new', methods=['POST'])
 def submit_new_tag():
     """handle new tag submission"""
 
@@ -78,6 +187,7 @@ def submit_new_tag():
     tag = Tag(name=name)
 
     db.session.add(tag)
+    CacheVersion.bump("tags")
     db.session.commit()
 
     return redirect('/tags')
@@ -85,63 +195,190 @@ def submit_new_tag():
 
 # Read
 
-@app.route('/', methods=['GET'])
+@bp.route('/', methods=['GET'])
 def home():
     """Home page, redirect to /users"""
 
     return redirect('/users')
 
-@app.route('/users', methods=['GET'])
+@bp.route('/users', methods=['GET'])
 def user_list():
-    """Get list of all users"""
-    
-    users = User.query.all()
-    return render_template("users.html", users=users)
+    """Get one page of the user directory"""
+
+    sort, columns, descending = list_order(USER_ORDERS)
+    users = keyset_paginate(User.query,
+                            columns,
+                            after=request.args.get("after"),
+                            before=request.args.get("before"),
+                            per_page=page_size('USERS_PER_PAGE'),
+                            descending=descending)
 
-@app.route('/users/<int:id>', methods = ['GET'])
+    return render_template("users.html", users=users, sort=sort, args=request.args)
+
+@bp.route('/users/<int:id>', methods = ['GET'])
 def user_profile(id):
     """Displays user profile"""
 
-    user = User.query.get_or_404(id)
-    posts = user.posts
+    def render():
+        user = (User.query
+                .options(selectinload(User.posts).load_only(Post.id, Post.title))
+                .get_or_404(id))
+        posts = user.posts
+
+        return render_template("profile.html", user=user, posts=posts)
 
-    return render_template("profile.html", user=user, posts=posts)
+    return conditional(User, id, lambda etag: fragment_cache.cached(user_key(id, etag), render))
 
-@app.route('/posts/<int:id>', methods=['GET'])
+@bp.route('/posts/<int:id>', methods=['GET'])
 def view_post(id):
     """Displays blog post details"""
 
-    post = Post.query.get_or_404(id)
+    def render():
+        post = (Post.query
+                .options(joinedload(Post.user), selectinload(Post.tags))
+                .get_or_404(id))
 
-    return render_template('post.html', post=post)
+        return render_template('post.html', post=post, related=RelatedPost.for_post(id))
 
-@app.route('/tags', methods=['GET'])
-def list_tags():
-    """List all tags"""
+    return conditional(Post, id, lambda etag: fragment_cache.cached(post_key(id, etag), render))
+
+@bp.route('/posts', methods=['GET'])
+def post_feed():
+    """Newest posts first"""
+
+    posts = Post.feed(after=request.args.get("after"),
+                      before=request.args.get("before"),
+                      per_page=page_size('FEED_PER_PAGE'))
+
+    return render_template('feed.html', posts=posts, tag=None, url='/posts',
+                           args=request.args)
 
-    tags = Tag.query.all()
+@bp.route('/tags/<int:id>/posts', methods=['GET'])
+def tag_feed(id):
+    """Newest posts with tag id first"""
 
-    return render_template('tags.html', tags=tags)
+    tag = Tag.query.options(load_only(Tag.id, Tag.name)).get_or_404(id)
+    posts = Post.feed(after=request.args.get("after"),
+                      before=request.args.get("before"),
+                      per_page=page_size('FEED_PER_PAGE'),
+                      tag_id=id)
 
-@app.route('/tags/<int:id>', methods=['GET'])
+    return render_template('feed.html', posts=posts, tag=tag, url=f'/tags/{id}/posts',
+                           args=request.args)
+
+@bp.route('/tags', methods=['GET'])
+def list_tags():
+    """List one page of tags with their post counts"""
+
+    sort, columns, descending = list_order(TAG_ORDERS)
+    tags = keyset_paginate(Tag.query,
+                           columns,
+                           after=request.args.get("after"),
+                           before=request.args.get("before"),
+                           per_page=page_size('TAGS_PER_PAGE'),
+                           descending=descending)
+
+    return render_template('tags.html', tags=tags, sort=sort, args=request.args)
+
+@bp.route('/tags/suggest', methods=['GET'])
+def suggest_tags():
+    """Up to ?limit= tags whose names start with ?prefix=, most used first"""
+
+    prefix = request.args.get("prefix", "").strip()
+    limit = request.args.get("limit", current_app.config['TAG_SUGGEST_LIMIT'], type=int)
+    limit = max(1, min(limit, current_app.config['MAX_TAG_SUGGEST_LIMIT']))
+
+    if not prefix:
+        tags = []
+    elif current_app.config['TAG_SUGGEST_SOURCE'] == "database":
+        tags = Tag.suggest(prefix, limit)
+    else:
+        tags = tag_catalog.get().trie.suggest(prefix, limit)
+
+    return jsonify(tags=[dict(id=tag.id, name=tag.name, post_count=tag.post_count)
+                         for tag in tags])
+
+@bp.route('/search', methods=['GET'])
+def search():
+    """Ranked full-text search over post titles and content"""
+
+    q = request.args.get("q", "")
+    tag_ids = request.args.getlist("tag", type=int)
+
+    hits = search_posts(db.session, q, tag_ids,
+                        after=request.args.get("after"),
+                        per_page=page_size('SEARCH_PER_PAGE'))
+
+    # Only the tags in the query; the selector suggests the rest
+    names = tag_catalog.get().names
+    tags = [dict(id=id, name=names[id]) for id in tag_ids if id in names]
+
+    return render_template('search.html', q=q, tag_ids=tag_ids, hits=hits, tags=tags)
+
+@bp.route('/api/search', methods=['GET'])
+def search_json():
+    """JSON variant of /search"""
+
+    hits = search_posts(db.session,
+                        request.args.get("q", ""),
+                        request.args.getlist("tag", type=int),
+                        after=request.args.get("after"),
+                        per_page=page_size('SEARCH_PER_PAGE'))
+
+    return jsonify(results=[dict(id=hit.id, title=hit.title, rank=hit.rank,
+                                 snippet=str(hit.snippet))
+                            for hit in hits],
+                   next=hits.next_cursor)
+
+@bp.route('/export/<kind>.<fmt>', methods=['GET'])
+def export(kind, fmt):
+    """Stream every row of kind as NDJSON or CSV.
+    Optional filters: ?user_id=, ?since= and ?until= (ISO dates, on post creation time)"""
+
+    if kind not in KINDS or fmt not in FORMATS:
+        raise NotFound()
+
+    try:
+        since = request.args.get("since")
+        since = since and datetime.fromisoformat(since)
+        until = request.args.get("until")
+        until = until and datetime.fromisoformat(until)
+    except ValueError:
+        raise BadRequest("since and until must be ISO dates")
+
+    chunks = export_chunks(kind, fmt,
+                           user_id=request.args.get("user_id", type=int),
+                           since=since or None,
+                           until=until or None)
+
+    return Response(stream_with_context(chunks),
+                    mimetype=FORMATS[fmt],
+                    headers={"Content-Disposition": f"attachment; filename={kind}.{fmt}"})
+
+@bp.route('/tags/<int:id>', methods=['GET'])
 def show_tag(id):
     """Show tag details"""
 
-    tag = Tag.query.get_or_404(id)
+    def render():
+        tag = (Tag.query
+               .options(selectinload(Tag.posts).load_only(Post.id, Post.title))
+               .get_or_404(id))
 
-    return render_template('tag.html', tag=tag)
+        return render_template('tag.html', tag=tag)
+
+    return conditional(Tag, id, lambda etag: fragment_cache.cached(tag_key(id, etag), render))
 
 
 # Update
 
-@app.route('/users/<int:id>/edit', methods = ['GET'])
+@bp.route('/users/<int:id>/edit', methods = ['GET'])
 def edit_user_form(id):
     """Show user edit form"""
 
     user = User.query.get_or_404(id)
     return render_template("edit_user.html", user=user)
 
-@app.route('/users/<int:id>/edit', methods = ['POST'])
+@bp.route('/users/<int:id>/edit', methods = ['POST'])
 def submit_user_edit(id):
     """Update new user data"""
 
@@ -154,15 +391,15 @@ def submit_user_edit(id):
 
     return redirect('/users')
 
-@app.route('/posts/<int:id>/edit', methods=['GET'])
+@bp.route('/posts/<int:id>/edit', methods=['GET'])
 def edit_post(id):
     """Show post edit form"""
 
-    post = Post.query.get_or_404(id)
-    tags = Tag.query.all()
-    return render_template('edit_post.html', post=post, tags=tags)
+    post = Post.query.options(selectinload(Post.tags)).get_or_404(id)
+
+    return render_template('edit_post.html', post=post)
 
-@app.route('/posts/<int:id>/edit', methods=['POST'])
+@bp.route('/posts/<int:id>/edit', methods=['POST'])
 def submit_post_edit(id):
     """Updates post"""
 
@@ -176,7 +413,7 @@ def submit_post_edit(id):
 
     return redirect(f"/posts/{id}")
 
-@app.route('/tags/<int:id>/edit', methods=['GET'])
+@bp.route('/tags/<int:id>/edit', methods=['GET'])
 def edit_tag(id):
     """Displays tag edit form"""
 
@@ -184,49 +421,210 @@ def edit_tag(id):
 
     return render_template('edit_tag.html', tag=tag)
 
-@app.route('/tags/<int:id>/edit', methods=['POST'])
+@bp.route('/tags/<int:id>/edit', methods=['POST'])
 def submit_edit_tag(id):
     """Updates tag"""
 
     name = request.form["tag-name"]
 
-    Tag.query.filter_by(id=id).update(dict(name=name))
-
-    db.session.commit()
+    tag = Tag.query.get_or_404(id)
+    tag.update(name)
 
     return redirect('/tags')
 
+@bp.route('/tags/<int:id>/merge', methods=['POST'])
+def merge_tags(id):
+    """Moves the posts of the chosen tags onto this one and removes them"""
+
+    tag = Tag.query.get_or_404(id)
+    source_ids = request.form.getlist("tags", type=int)
+    name = request.form.get("tag-name")
+
+    if name and Tag.name_taken(name, [id, *source_ids]):
+        flash(f"There is already a tag named {name}")
+        return render_template('edit_tag.html', tag=tag), 400
+
+    Tag.merge(id, source_ids, name)
+
+    return redirect(f'/tags/{id}')
+
 
 # Delete
 
-@app.route('/users/<int:id>/delete', methods=['POST'])
+@bp.route('/users/<int:id>/delete', methods=['POST'])
 def delete_user(id):
-    """Removes user from database"""
+    """Marks user and their posts deleted; the purge removes the rows"""
 
     User.remove_user(id)
+    purge_worker.schedule()
 
     return redirect('/users')
 
-@app.route('/posts/<int:id>/delete', methods=['POST'])
+@bp.route('/posts/<int:id>/delete', methods=['POST'])
 def delete_post(id):
-    """Removes post from database, redirects to post's author profile"""
+    """Marks post deleted, redirects to post's author profile"""
 
     user_id = Post.remove_post(id)
+    purge_worker.schedule()
 
     return redirect(f"/users/{user_id}")
 
-@app.route('/tags/<int:id>/delete', methods=['POST'])
+@bp.route('/tags/<int:id>/delete', methods=['POST'])
 def delete_tag(id):
-    """Removes tag from database"""
+    """Marks tag deleted; the purge removes it and its post links"""
 
     Tag.remove_tag(id)
+    purge_worker.schedule()
 
     return redirect('/tags')
 
 
+# Metrics
+
+@bp.route('/metrics', methods=['GET'])
+def metrics_endpoint():
+    """Per-endpoint request, SQL and render histograms for Prometheus"""
+
+    return Response(metrics.render_prometheus(), mimetype="text/plain; version=0.0.4")
+
+
+# Commands
+
+@bp.cli.command("init-db")
+def init_db_command():
+    """Create any missing tables and indexes"""
+
+    db.create_all()
+
+
+@bp.cli.command("reconcile-counts")
+def reconcile_counts_command():
+    """Recount user and tag post counts, fixing any that drifted"""
+
+    users = User.reconcile_post_counts()
+    tags = Tag.reconcile_post_counts()
+    db.session.commit()
+
+    click.echo(f"Fixed post counts of {users} users and {tags} tags")
+
+
+@bp.cli.command("render-posts")
+@click.option("--workers", type=int, default=os.cpu_count(), help="Rendering processes")
+@click.option("--batch-size", type=int, default=1000)
+def render_posts_command(workers, batch_size):
+    """Re-render post content written by an older renderer version"""
+
+    with ProcessPoolExecutor(workers) as pool:
+        rendered = Post.render_stale(batch_size, map=pool.map)
+
+    click.echo(f"Rendered {rendered} posts")
+
+
+@bp.cli.command("purge")
+@click.option("--batch-size", type=int, help="Rows per transaction [PURGE_BATCH_SIZE]")
+@click.option("--pause", type=float, help="Seconds between batches [PURGE_PAUSE_SECONDS]")
+@click.option("--every", type=float, help="Keep running, purging every this many seconds")
+def purge_command(batch_size, pause, every):
+    """Delete soft-deleted users, posts and tags for good"""
+
+    batch_size = batch_size or current_app.config["PURGE_BATCH_SIZE"]
+    pause = current_app.config["PURGE_PAUSE_SECONDS"] if pause is None else pause
+
+    while True:
+        counts = purge(batch_size, pause)
+        click.echo(", ".join(f"{table}: {rows}" for table, rows in counts.items()))
+
+        if every is None:
+            return
+
+        time.sleep(every)
+
+
+@bp.cli.command("related-posts")
+@click.option("--batch-size", type=int, default=1000, help="Posts scored per matrix product")
+@click.option("--top", type=int, default=5, help="Related posts kept per post")
+@click.option("--max-tag-share", type=float, default=0.1,
+              help="Ignore tags on more than this share of posts")
+def related_posts_command(batch_size, top, max_tag_share):
+    """Recompute every post's related posts from shared tags"""
+
+    # numpy and scipy are slow to import and only this command needs them
+    from related import rebuild_related
+
+    changed = rebuild_related(batch_size, top, max_tag_share)
+    click.echo(f"Updated related posts of {changed} posts")
+
+
+@bp.cli.command("merge-tags")
+@click.argument("target")
+@click.argument("sources", nargs=-1, required=True)
+@click.option("--rename", help="New name for TARGET, e.g. one of the SOURCES'")
+def merge_tags_command(target, sources, rename):
+    """Move the posts of tags named SOURCES onto the tag named TARGET and remove them"""
+
+    ids = dict(db.session.query(Tag.name, Tag.id).filter(Tag.name.in_([target, *sources])))
+    missing = [name for name in [target, *sources] if name not in ids]
+
+    if missing:
+        raise click.ClickException(f"No such tags: {', '.join(missing)}")
+
+    source_ids = [ids[name] for name in sources]
+
+    if rename and Tag.name_taken(rename, [ids[target], *source_ids]):
+        raise click.ClickException(f"There is already a tag named {rename}")
+
+    merged = Tag.merge(ids[target], source_ids, rename)
+    click.echo(f"Merged {len(merged)} tags into {rename or target}")
+
+
+@bp.cli.command("reindex-search")
+def reindex_search_command():
+    """Rebuild the post search index from scratch"""
+
+    reindex_all(db.session)
+    db.session.commit()
+
+
+@bp.cli.command("export")
+@click.argument("kind", type=click.Choice(KINDS))
+@click.option("--format", "fmt", type=click.Choice(list(FORMATS)), default="ndjson")
+@click.option("--user-id", type=int, help="Only rows belonging to this user")
+@click.option("--since", type=click.DateTime(), help="Only posts created at or after this time")
+@click.option("--until", type=click.DateTime(), help="Only posts created before this time")
+@click.option("--output", type=click.File("w"), default="-")
+def export_command(kind, fmt, user_id, since, until, output):
+    """Stream an export of KIND to a file or stdout"""
+
+    for chunk in export_chunks(kind, fmt, user_id, since, until):
+        output.write(chunk)
+
+
+@bp.cli.command("import")
+@click.option("--users", type=click.Path(exists=True, dir_okay=False))
+@click.option("--tags", type=click.Path(exists=True, dir_okay=False))
+@click.option("--posts", type=click.Path(exists=True, dir_okay=False))
+@click.option("--post-tags", type=click.Path(exists=True, dir_okay=False),
+              help="Links of post_id to tag name")
+@click.option("--batch-size", type=int, default=5000)
+def import_command(users, tags, posts, post_tags, batch_size):
+    """Bulk-load NDJSON or CSV files; rows that already exist are skipped"""
+
+    def progress(kind, rows, seconds):
+        click.echo(f"{kind}: {rows} rows, {rows / max(seconds, 1e-9):.0f} rows/s")
+
+    paths = dict(users=users, tags=tags, posts=posts, post_tags=post_tags)
+    counts = import_files(paths, batch_size, progress)
+
+    click.echo(", ".join(f"{kind}: {rows}" for kind, rows in counts.items()) or "Nothing to import")
+
+    if "posts" in counts:
+        click.echo("Run `flask render-posts` to render the imported posts' content")
+
+
+
 # Universal error route
 
-@app.errorhandler(Exception)
+@bp.app_errorhandler(Exception)
 def error_page(e):
 
     if isinstance(e, HTTPException):
@@ -0,0 +1,345 @@
+"""ASGI entry point with async versions of the read routes.
+
+    uvicorn --factory asgi:create_asgi_app --workers 2
+
+GET and HEAD requests for user_list, user_profile, view_post, list_tags
+and show_tag are served on an AsyncSession over asyncpg (or aiosqlite),
+so one worker process keeps many readers in flight while their queries
+wait on the database. They use the same loading plans, templates,
+sort orders, fragment cache and ETags as the routes in app.py. Every
+other request is handed to the Flask app through asgiref's WSGI
+adapter, which runs it in a thread."""
+
+import os
+import random
+import re
+import time
+
+from asgiref.wsgi import WsgiToAsgi
+from flask import render_template
+from sqlalchemy import select
+from sqlalchemy.engine import make_url
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
+from sqlalchemy.orm import joinedload, selectinload, sessionmaker
+from werkzeug.datastructures import Headers
+from werkzeug.exceptions import HTTPException, NotFound
+from werkzeug.http import http_date, is_resource_modified, parse_cookie
+from werkzeug.urls import url_decode
+
+from app import (create_app, error_page, list_order, page_etag, page_size,
+                 USER_ORDERS, TAG_ORDERS)
+from cache import fragment_cache, post_key, user_key, tag_key
+from instrumentation import metrics
+from models import User, Post, Tag, RelatedPost
+from pagination import keyset_page, keyset_window
+from routing import QUEUE_POOL_OPTIONS, STICKY_COOKIE
+
+ASYNC_DRIVERS = {"postgresql": "postgresql+asyncpg", "sqlite": "sqlite+aiosqlite"}
+
+
+def async_url(uri, root_path):
+    """The async driver's URL for a Flask-SQLAlchemy database URI"""
+
+    url = make_url(uri)
+    backend = url.get_backend_name()
+
+    if backend not in ASYNC_DRIVERS:
+        raise ValueError(f"No async driver for {backend!r} databases")
+
+    url = url.set(drivername=ASYNC_DRIVERS[backend])
+
+    # Flask-SQLAlchemy resolves relative SQLite paths against the app root
+    if backend == "sqlite" and url.database not in (None, "", ":memory:"):
+        url = url.set(database=os.path.join(root_path, url.database))
+
+    return url
+
+
+def async_engine(app, uri, **overrides):
+    url = async_url(uri, app.root_path)
+    options = dict(app.config["SQLALCHEMY_ENGINE_OPTIONS"], **overrides)
+
+    if url.get_backend_name() == "sqlite":
+        for option in QUEUE_POOL_OPTIONS:
+            options.pop(option, None)
+
+    return create_async_engine(url, echo=app.config["SQLALCHEMY_ECHO"], **options)
+
+
+class Request:
+    """What the async routes need from an ASGI HTTP scope"""
+
+    def __init__(self, scope):
+        self.method = scope["method"]
+        self.path = scope["path"]
+        self.args = url_decode(scope["query_string"])
+        self.headers = Headers([(name.decode("latin-1"), value.decode("latin-1"))
+                                for name, value in scope["headers"]])
+        self.cookies = parse_cookie(self.headers.get("Cookie", ""))
+
+    @property
+    def environ(self):
+        """Just enough of a WSGI environ for werkzeug's conditional helpers"""
+
+        environ = {"REQUEST_METHOD": self.method}
+
+        for header in ("If-None-Match", "If-Modified-Since"):
+            if header in self.headers:
+                environ["HTTP_" + header.upper().replace("-", "_")] = self.headers[header]
+
+        return environ
+
+
+class Reply:
+    """Status, headers and body of an async route's response"""
+
+    def __init__(self, body="", status=200, headers=None):
+        self.body = body
+        self.status = status
+        self.headers = headers or {}
+
+
+# Routes
+
+async def user_list(session, request):
+    """Get one page of the user directory"""
+
+    users, sort = await keyset_list(session, request, User, USER_ORDERS, 'USERS_PER_PAGE')
+
+    return Reply(render_template("users.html", users=users, sort=sort,
+                                 args=request.args))
+
+
+async def user_profile(session, request, id):
+    """Displays user profile"""
+
+    async def render():
+        result = await session.execute(
+            select(User).where(User.id == id)
+            .options(selectinload(User.posts).load_only(Post.id, Post.title)))
+        user = result.scalar_one_or_none()
+
+        if user is None:
+            raise NotFound()
+
+        return render_template("profile.html", user=user, posts=user.posts)
+
+    return await conditional(session, request, User, id,
+                             lambda etag: fragment_cache.cached_async(user_key(id, etag), render))
+
+
+async def view_post(session, request, id):
+    """Displays blog post details"""
+
+    async def render():
+        result = await session.execute(
+            select(Post).where(Post.id == id)
+            .options(joinedload(Post.user), selectinload(Post.tags)))
+        post = result.scalar_one_or_none()
+
+        if post is None:
+            raise NotFound()
+
+        result = await session.execute(
+            select(Post.id, Post.title)
+            .join(RelatedPost, RelatedPost.related_id == Post.id)
+            .where(RelatedPost.post_id == id)
+            .order_by(RelatedPost.rank))
+
+        return render_template("post.html", post=post, related=result.all())
+
+    return await conditional(session, request, Post, id,
+                             lambda etag: fragment_cache.cached_async(post_key(id, etag), render))
+
+
+async def list_tags(session, request):
+    """List one page of tags with their post counts"""
+
+    tags, sort = await keyset_list(session, request, Tag, TAG_ORDERS, 'TAGS_PER_PAGE')
+
+    return Reply(render_template("tags.html", tags=tags, sort=sort, args=request.args))
+
+
+async def show_tag(session, request, id):
+    """Show tag details"""
+
+    async def render():
+        result = await session.execute(
+            select(Tag).where(Tag.id == id)
+            .options(selectinload(Tag.posts).load_only(Post.id, Post.title)))
+        tag = result.scalar_one_or_none()
+
+        if tag is None:
+            raise NotFound()
+
+        return render_template("tag.html", tag=tag)
+
+    return await conditional(session, request, Tag, id,
+                             lambda etag: fragment_cache.cached_async(tag_key(id, etag), render))
+
+
+async def keyset_list(session, request, model, orders, per_page_key):
+    """One keyset page of model in the ?sort= order, as (page, sort)"""
+
+    sort, columns, descending = list_order(orders, request.args)
+    after = request.args.get("after")
+    before = request.args.get("before")
+    per_page = page_size(per_page_key, request.args)
+
+    result = await session.execute(
+        keyset_window(select(model), columns, after, before, per_page, descending))
+
+    return keyset_page(result.scalars().all(), columns, after, before, per_page), sort
+
+
+async def conditional(session, request, model, id, render):
+    """app.conditional for async routes"""
+
+    updated_at = await session.scalar(select(model.updated_at).where(model.id == id))
+
+    if updated_at is None:
+        raise NotFound()
+
+    etag = page_etag(model, id, updated_at)
+    headers = {"ETag": f'"{etag}"',
+               "Last-Modified": http_date(updated_at),
+               "Cache-Control": "no-cache"}
+
+    if not is_resource_modified(request.environ, etag, last_modified=updated_at):
+        return Reply(status=304, headers=headers)
+
+    return Reply(await render(etag), headers=headers)
+
+
+ROUTES = [
+    (re.compile(r"/users"), user_list),
+    (re.compile(r"/users/(\d+)"), user_profile),
+    (re.compile(r"/posts/(\d+)"), view_post),
+    (re.compile(r"/tags"), list_tags),
+    (re.compile(r"/tags/(\d+)"), show_tag),
+]
+
+
+class AsyncBlogly:
+    """ASGI app: async read routes in front of the Flask app.
+    engine_options override SQLALCHEMY_ENGINE_OPTIONS for the async engines."""
+
+    def __init__(self, app, **engine_options):
+        self.app = app
+        self.wsgi = WsgiToAsgi(app)
+        self.primary = async_engine(app, app.config["SQLALCHEMY_DATABASE_URI"], **engine_options)
+        self.replicas = [async_engine(app, uri, **engine_options)
+                         for uri in app.config.get("SQLALCHEMY_REPLICA_URIS") or ()]
+        self.sessions = sessionmaker(class_=AsyncSession, expire_on_commit=False)
+
+    def __repr__(self):
+        """Show info about app"""
+
+        return f"<AsyncBlogly {self.primary.url} {len(self.replicas)} replicas>"
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "lifespan":
+            return await self.lifespan(receive, send)
+
+        if scope["type"] == "http" and scope["method"] in ("GET", "HEAD"):
+            for pattern, route in ROUTES:
+                match = pattern.fullmatch(scope["path"])
+
+                if match:
+                    return await self.serve(scope, send, route, [int(id) for id in match.groups()])
+
+        return await self.wsgi(scope, receive, send)
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+
+            if message["type"] == "lifespan.startup":
+                await send({"type": "lifespan.startup.complete"})
+
+            elif message["type"] == "lifespan.shutdown":
+                await self.dispose()
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+
+    async def dispose(self):
+        for engine in [self.primary] + self.replicas:
+            await engine.dispose()
+
+    def engine_for(self, request):
+        """A replica unless the client just wrote, as in routing.RoutingSession"""
+
+        if self.replicas and STICKY_COOKIE not in request.cookies:
+            return random.choice(self.replicas)
+
+        return self.primary
+
+    async def serve(self, scope, send, route, args):
+        started = time.perf_counter()
+        request = Request(scope)
+
+        with self.app.app_context():
+            try:
+                async with self.sessions(bind=self.engine_for(request)) as session:
+                    reply = await route(session, request, *args)
+            except Exception as e:
+                reply = Reply(*self.error(e))
+
+        total = time.perf_counter() - started
+        reply.headers["Server-Timing"] = f"total;dur={total * 1000:.2f}"
+        metrics.observe(f"async.{route.__name__}", {"blogly_request_duration_seconds": total})
+
+        body = b"" if reply.status == 304 else reply.body.encode()
+        headers = [(b"content-type", b"text/html; charset=utf-8"),
+                   (b"content-length", str(len(body)).encode())]
+        headers += [(name.lower().encode(), value.encode())
+                    for name, value in reply.headers.items()]
+
+        await send({"type": "http.response.start", "status": reply.status, "headers": headers})
+        await send({"type": "http.response.body",
+                    "body": b"" if scope["method"] == "HEAD" else body})
+
+    def error(self, e):
+        """Render e with the Flask app's error page, as (body, status)"""
+
+        if not isinstance(e, HTTPException):
+            self.app.logger.exception("Error in async route")
+
+        rv = error_page(e)
+
+        return rv if isinstance(rv, tuple) else (rv, 200)
+
+
+def create_asgi_app(config=None):
+    """ASGI app for a configuration profile, see app.create_app"""
+
+    return AsyncBlogly(create_app(config))
+
+
+async def request(app, path, headers=()):
+    """Send one GET through an ASGI app in-process and return
+    (status, headers, body). Used by the tests and benchmarks."""
+
+    path, _, query = path.partition("?")
+    scope = {"type": "http", "asgi": {"version": "3.0"}, "http_version": "1.1",
+             "method": "GET", "scheme": "http", "path": path, "raw_path": path.encode(),
+             "root_path": "", "query_string": query.encode(),
+             "headers": [(b"host", b"localhost")] +
+                        [(name.lower().encode(), value.encode()) for name, value in headers],
+             "client": ("127.0.0.1", 0), "server": ("localhost", 80)}
+    messages = []
+
+    async def receive():
+        return {"type": "http.request", "body": b"", "more_body": False}
+
+    async def send(message):
+        messages.append(message)
+
+    await app(scope, receive, send)
+
+    start = messages[0]
+    body = b"".join(message.get("body", b"") for message in messages[1:])
+
+    return (start["status"],
+            {name.decode(): value.decode() for name, value in start["headers"]},
+            body.decode())
@@ -0,0 +1,511 @@
+"""Route-level load and latency benchmarks for Blogly.
+
+    flask bench generate --users 10000 --posts 1000000 --tags 2000 --reset
+    flask bench run --requests 200 --baseline bench_baseline.json
+    flask bench cold-start --profile production --runs 10
+    flask bench async --connections 5 --concurrency 50
+
+'generate' loads a synthetic dataset through the bulk importer, with post
+authorship and tag usage skewed the way real blogs are. 'run' drives
+every route through the Flask test client and records p50/p95/p99
+latency, SQL statement count and peak Python memory per route. Given a
+baseline it exits non-zero when any route regresses. 'cold-start' times
+a fresh interpreter from importing the app to serving its first request,
+and 'async' compares read throughput of the sync and async apps."""
+
+import itertools
+import json
+import math
+import os
+import random
+import statistics
+import subprocess
+import sys
+import time
+import tracemalloc
+from collections import namedtuple
+from datetime import datetime, timedelta
+
+import click
+from flask import current_app
+from flask.cli import AppGroup
+from sqlalchemy import func
+
+from importer import import_records, finish_import
+from instrumentation import QueryCounter
+from models import db, User, Post, Tag, PostTag
+
+WORDS = ("python flask postgres index query cursor latency cache template "
+         "database migration worker request response router session commit "
+         "giraffe walrus otter heron badger falcon lynx marmot ibis tapir "
+         "morning evening garden harbor mountain river forest desert island "
+         "quick quiet bright heavy gentle rapid hollow silver golden amber").split()
+
+Route = namedtuple("Route", "name method path data prepare")
+
+
+def route(name, method, path, data=None, prepare=None):
+    return Route(name, method, path, data, prepare)
+
+
+# Datasets
+
+def words(rng, low, high):
+    return " ".join(rng.choices(WORDS, k=rng.randint(low, high)))
+
+
+def generate(users, posts, tags, skew=1.1, seed=0, batch_size=5000, progress=None):
+    """Append a synthetic dataset after the existing rows and return row counts.
+
+    Post authorship follows a power law, and tag usage follows a Zipf
+    distribution with exponent skew, so a few authors and tags are hot."""
+
+    rng = random.Random(seed)
+    first_user = (db.session.query(func.max(User.id)).scalar() or 0) + 1
+    first_post = (db.session.query(func.max(Post.id)).scalar() or 0) + 1
+    tag_names = [f"{rng.choice(WORDS)}-{n}" for n in range(tags)]
+    tag_weights = list(itertools.accumulate(1 / rank ** skew for rank in range(1, tags + 1)))
+    started = datetime.utcnow() - timedelta(days=730)
+    step = timedelta(days=730) / max(posts, 1)
+
+    def user_rows():
+        for n in range(users):
+            yield dict(id=first_user + n,
+                       first_name=rng.choice(WORDS).title(),
+                       last_name=f"{rng.choice(WORDS).title()}{n}",
+                       image_url="")
+
+    def post_rows():
+        for n in range(posts):
+            yield dict(id=first_post + n,
+                       user_id=first_user + int(users * rng.random() ** 3),
+                       title=words(rng, 2, 6).capitalize(),
+                       content=words(rng, 20, 80),
+                       created_at=started + step * n)
+
+    def post_tag_rows():
+        for n in range(posts):
+            chosen = rng.choices(tag_names, cum_weights=tag_weights, k=rng.randint(0, 4))
+
+            for name in set(chosen):
+                yield dict(post_id=first_post + n, tag=name)
+
+    counts = {}
+    for kind, rows in [("users", user_rows()),
+                       ("tags", (dict(name=name) for name in tag_names)),
+                       ("posts", post_rows()),
+                       ("post_tags", post_tag_rows())]:
+        counts[kind] = import_records(kind, rows, batch_size, progress)
+        db.session.commit()
+
+    finish_import(counts)
+
+    return counts
+
+
+# Routes
+
+class Sample:
+    """Random ids of existing rows for requests to aim at"""
+
+    def __init__(self, rng, size=500):
+        self.rng = rng
+        self.users = sample_ids(User, size, rng)
+        self.posts = sample_ids(Post, size, rng)
+        self.tags = sample_ids(Tag, size, rng)
+
+    def user(self):
+        return self.rng.choice(self.users)
+
+    def post(self):
+        return self.rng.choice(self.posts)
+
+    def tag(self):
+        return self.rng.choice(self.tags)
+
+    def word(self):
+        return self.rng.choice(WORDS)
+
+
+def sample_ids(model, size, rng):
+    """Up to size random primary keys of model, without an ORDER BY random() scan"""
+
+    low, high = db.session.query(func.min(model.id), func.max(model.id)).one()
+
+    if low is None:
+        raise click.ClickException(f"No {model.__tablename__} to benchmark; run 'flask bench generate'")
+
+    guesses = {rng.randint(low, high) for _ in range(size * 4)}
+    ids = [id for (id,) in db.session.query(model.id).filter(model.id.in_(guesses))]
+
+    return ids[:size] or [low]
+
+
+def scratch_post(sample):
+    return Post.create(sample.user(), "Benchmark post", "Benchmark content")
+
+
+def scratch_user(sample):
+    user = User(first_name="Benchmark", last_name="User", image_url="")
+    db.session.add(user)
+    db.session.flush()
+    Post.insert_many([dict(user_id=user.id, title="Benchmark post", content="Benchmark content")
+                      for _ in range(5)])
+    db.session.commit()
+    return user.id
+
+
+def scratch_tag(sample):
+    tag = Tag(name=f"bench-{time.perf_counter_ns()}")
+    db.session.add(tag)
+    db.session.commit()
+    return tag.id
+
+
+def scratch_tagged(sample):
+    id = scratch_tag(sample)
+    post_ids = {sample.post() for _ in range(5)}
+    db.session.execute(PostTag.__table__.insert(),
+                       [dict(post_id=post_id, tag_id=id) for post_id in post_ids])
+    Tag.adjust_post_counts({id: len(post_ids)})
+    db.session.commit()
+    return id
+
+
+user_data = lambda s, _: {"first-name": "Bench", "last-name": "Mark", "img-url": ""}
+post_data = lambda s, _: {"title": "Bench post", "content": "Bench content",
+                          "tags": list({s.tag(), s.tag()})}
+
+ROUTES = [
+    route("user_form", "GET", lambda s, _: "/users/new"),
+    route("submit_user_form", "POST", lambda s, _: "/users/new", user_data),
+    route("post_form", "GET", lambda s, _: f"/users/{s.user()}/posts/new"),
+    route("post_form_submit", "POST", lambda s, _: f"/users/{s.user()}/posts/new", post_data),
+    route("create_posts_json", "POST", lambda s, _: "/api/posts",
+          lambda s, _: json.dumps({"posts": [dict(title="Bench post", content="Bench content",
+                                                  user_id=s.user(), tags=[s.tag()])
+                                             for n in range(10)]})),
+    route("new_tag", "GET", lambda s, _: "/tags/new"),
+    route("submit_new_tag", "POST", lambda s, _: "/tags/new",
+          lambda s, _: {"tag-name": f"bench-{time.perf_counter_ns()}"}),
+    route("home", "GET", lambda s, _: "/"),
+    route("user_list", "GET", lambda s, _: "/users"),
+    route("user_list_by_posts", "GET", lambda s, _: "/users?sort=posts"),
+    route("user_profile", "GET", lambda s, _: f"/users/{s.user()}"),
+    route("view_post", "GET", lambda s, _: f"/posts/{s.post()}"),
+    route("post_feed", "GET", lambda s, _: "/posts"),
+    route("tag_feed", "GET", lambda s, _: f"/tags/{s.tag()}/posts"),
+    route("search", "GET", lambda s, _: f"/search?q={s.word()}"),
+    route("search_json", "GET", lambda s, _: f"/api/search?q={s.word()}"),
+    route("export", "GET", lambda s, _: f"/export/posts.ndjson?user_id={s.user()}"),
+    route("list_tags", "GET", lambda s, _: "/tags"),
+    route("list_tags_by_posts", "GET", lambda s, _: "/tags?sort=posts"),
+    route("show_tag", "GET", lambda s, _: f"/tags/{s.tag()}"),
+    route("suggest_tags", "GET", lambda s, _: f"/tags/suggest?prefix={s.word()[:2]}"),
+    route("edit_user_form", "GET", lambda s, _: f"/users/{s.user()}/edit"),
+    route("submit_user_edit", "POST", lambda s, _: f"/users/{s.user()}/edit",
+          lambda s, _: {"first-name": "", "last-name": "", "img-url": ""}),
+    route("edit_post", "GET", lambda s, _: f"/posts/{s.post()}/edit"),
+    route("submit_post_edit", "POST", lambda s, _: f"/posts/{s.post()}/edit", post_data),
+    route("edit_tag", "GET", lambda s, _: f"/tags/{s.tag()}/edit"),
+    route("submit_edit_tag", "POST", lambda s, id: f"/tags/{id}/edit",
+          lambda s, _: {"tag-name": f"bench-{time.perf_counter_ns()}"}, scratch_tag),
+    route("merge_tags", "POST", lambda s, _: f"/tags/{s.tag()}/merge",
+          lambda s, id: {"tags": [id]}, scratch_tagged),
+    route("delete_user", "POST", lambda s, id: f"/users/{id}/delete", prepare=scratch_user),
+    route("delete_post", "POST", lambda s, id: f"/posts/{id}/delete", prepare=scratch_post),
+    route("delete_tag", "POST", lambda s, id: f"/tags/{id}/delete", prepare=scratch_tag),
+    route("metrics_endpoint", "GET", lambda s, _: "/metrics"),
+]
+
+
+# Measurement
+
+def percentile(values, pct):
+    """Nearest-rank percentile of values"""
+
+    ordered = sorted(values)
+    return ordered[max(0, math.ceil(pct / 100 * len(ordered)) - 1)]
+
+
+def call(client, route, sample):
+    """Prepare and send one request for route; returns (response, ms, SQL statements run)"""
+
+    prepared = route.prepare(sample) if route.prepare else None
+    path = route.path(sample, prepared)
+    data = route.data(sample, prepared) if route.data else None
+
+    with QueryCounter(db.engine) as queries:
+        started = time.perf_counter()
+        # JSON routes give their body as a string
+        content_type = "application/json" if isinstance(data, str) else None
+        response = client.open(path, method=route.method, data=data, content_type=content_type)
+        response.get_data()
+        elapsed = (time.perf_counter() - started) * 1000
+
+    if response.status_code >= 500:
+        raise click.ClickException(f"{route.name}: {path} returned {response.status_code}")
+
+    return response, elapsed, queries.statements
+
+
+def measure(client, route, sample, requests):
+    """Latency percentiles, worst statement count and peak memory for route"""
+
+    latencies = []
+    statements = 0
+
+    for _ in range(requests):
+        response, elapsed, run = call(client, route, sample)
+        latencies.append(elapsed)
+        statements = max(statements, len(run))
+
+    # Memory is traced in a separate request; tracing slows everything down
+    tracemalloc.start()
+    try:
+        call(client, route, sample)
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+    return dict(p50=percentile(latencies, 50),
+                p95=percentile(latencies, 95),
+                p99=percentile(latencies, 99),
+                queries=statements,
+                peak_kb=peak / 1024)
+
+
+def run(requests=50, names=None, seed=0):
+    """Benchmark every route (or those named) and return {route: metrics}"""
+
+    sample = Sample(random.Random(seed))
+    client = current_app.test_client()
+    results = {}
+
+    for route in ROUTES:
+        if names and route.name not in names:
+            continue
+
+        results[route.name] = measure(client, route, sample, requests)
+
+    return results
+
+
+def compare(results, baseline, tolerance=0.25, floor_ms=2.0):
+    """Return a message for each route that regressed against baseline.
+
+    Latency and memory may grow by tolerance (and latency by at least
+    floor_ms, to ride out timer noise); statement counts may not grow at all."""
+
+    regressions = []
+
+    for name, current in results.items():
+        base = baseline.get(name)
+
+        if base is None:
+            continue
+
+        # p99 over a few hundred requests is too noisy to gate on
+        for metric in ("p50", "p95"):
+            limit = max(base[metric] * (1 + tolerance), base[metric] + floor_ms)
+
+            if current[metric] > limit:
+                regressions.append(f"{name}: {metric} {current[metric]:.1f}ms > {limit:.1f}ms")
+
+        if current["queries"] > base["queries"]:
+            regressions.append(f"{name}: {current['queries']} statements > {base['queries']}")
+
+        limit = base["peak_kb"] * (1 + tolerance) + 64
+        if current["peak_kb"] > limit:
+            regressions.append(f"{name}: peak {current['peak_kb']:.0f}KB > {limit:.0f}KB")
+
+    return regressions
+
+
+# Async throughput
+
+ASYNC_ROUTES = ("user_list", "user_profile", "view_post", "list_tags", "show_tag")
+
+
+def throughput(requests=500, connections=5, concurrency=50, seed=0):
+    """Requests per second over the async read routes, served by the sync
+    app with one thread per connection and by asgi.AsyncBlogly with
+    concurrency requests in flight over a pool of the same connections.
+    Returns {"sync": rps, "async": rps}."""
+
+    import asyncio
+    from concurrent.futures import ThreadPoolExecutor
+
+    from asgi import AsyncBlogly, request
+
+    sample = Sample(random.Random(seed))
+    routes = [route for route in ROUTES if route.name in ASYNC_ROUTES]
+    paths = [routes[n % len(routes)].path(sample, None) for n in range(requests)]
+    app = current_app._get_current_object()
+
+    def get(path):
+        with app.test_client() as client:
+            if client.get(path).status_code >= 500:
+                raise click.ClickException(f"{path} failed on the sync app")
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=connections) as pool:
+        list(pool.map(get, paths))
+    sync_seconds = time.perf_counter() - started
+
+    async def drive():
+        blogly = AsyncBlogly(app, pool_size=connections, max_overflow=0)
+        pending = iter(paths)
+
+        async def worker():
+            for path in pending:
+                status, _, _ = await request(blogly, path)
+
+                if status >= 500:
+                    raise click.ClickException(f"{path} failed on the async app")
+
+        started = time.perf_counter()
+        await asyncio.gather(*[worker() for _ in range(concurrency)])
+        seconds = time.perf_counter() - started
+
+        await blogly.dispose()
+
+        return seconds
+
+    async_seconds = asyncio.run(drive())
+
+    return {"sync": requests / sync_seconds, "async": requests / async_seconds}
+
+
+# Cold start
+
+COLD_START = """
+import json, sys, time
+started = time.perf_counter()
+from app import create_app
+imported = time.perf_counter()
+app = create_app(sys.argv[1])
+created = time.perf_counter()
+status = app.test_client().get(sys.argv[2]).status_code
+finished = time.perf_counter()
+print(json.dumps(dict(import_ms=(imported - started) * 1000,
+                      create_ms=(created - imported) * 1000,
+                      first_request_ms=(finished - created) * 1000,
+                      status=status)))
+"""
+
+
+def cold_start(profile="production", path="/users", runs=5):
+    """Median milliseconds for each step from a fresh interpreter to the
+    first response: importing app, create_app(profile) and requesting path.
+    process_ms is the whole subprocess, interpreter startup included."""
+
+    root = os.path.dirname(os.path.abspath(__file__))
+    samples = []
+
+    for _ in range(runs):
+        started = time.perf_counter()
+        output = subprocess.run([sys.executable, "-c", COLD_START, profile, path],
+                                cwd=root, capture_output=True, text=True, check=True).stdout
+        process_ms = (time.perf_counter() - started) * 1000
+
+        # SQL echo in the development profile also writes to stdout
+        sample = json.loads(output.strip().splitlines()[-1])
+        sample["process_ms"] = process_ms
+        samples.append(sample)
+
+    result = {key: statistics.median(sample[key] for sample in samples)
+              for key in ("import_ms", "create_ms", "first_request_ms", "process_ms")}
+    result["status"] = samples[-1]["status"]
+
+    return result
+
+
+# Commands
+
+bench = AppGroup("bench", help="Generate benchmark data and benchmark every route")
+
+
+@bench.command("generate")
+@click.option("--users", type=int, default=10000)
+@click.option("--posts", type=int, default=1000000)
+@click.option("--tags", type=int, default=2000)
+@click.option("--skew", type=float, default=1.1, help="Zipf exponent of tag usage")
+@click.option("--seed", type=int, default=0)
+@click.option("--reset", is_flag=True, help="Drop and recreate every table first")
+def generate_command(users, posts, tags, skew, seed, reset):
+    """Load a synthetic dataset into the configured database"""
+
+    if reset:
+        db.drop_all()
+        db.create_all()
+
+    def progress(kind, rows, seconds):
+        if rows % 100000 < 5000:
+            click.echo(f"{kind}: {rows} rows, {rows / max(seconds, 1e-9):.0f} rows/s")
+
+    counts = generate(users, posts, tags, skew, seed, progress=progress)
+    click.echo(", ".join(f"{kind}: {rows}" for kind, rows in counts.items()))
+
+
+@bench.command("run")
+@click.option("--requests", type=int, default=50, help="Requests per route")
+@click.option("--route", "names", multiple=True, help="Only benchmark these routes")
+@click.option("--seed", type=int, default=0)
+@click.option("--baseline", type=click.Path(dir_okay=False), help="Baseline JSON to compare with")
+@click.option("--save-baseline", is_flag=True, help="Write the results to --baseline")
+@click.option("--tolerance", type=float, default=0.25)
+def run_command(requests, names, seed, baseline, save_baseline, tolerance):
+    """Benchmark routes and fail on regressions against a baseline"""
+
+    results = run(requests, names, seed)
+
+    click.echo(f"{'route':<20} {'p50':>8} {'p95':>8} {'p99':>8} {'sql':>5} {'peak KB':>9}")
+    for name, r in results.items():
+        click.echo(f"{name:<20} {r['p50']:>8.2f} {r['p95']:>8.2f} {r['p99']:>8.2f} "
+                   f"{r['queries']:>5} {r['peak_kb']:>9.0f}")
+
+    if not baseline:
+        return
+
+    if save_baseline:
+        with open(baseline, "w") as file:
+            json.dump(results, file, indent=2, sort_keys=True)
+        click.echo(f"Saved baseline to {baseline}")
+        return
+
+    with open(baseline) as file:
+        regressions = compare(results, json.load(file), tolerance)
+
+    for message in regressions:
+        click.echo(f"REGRESSION {message}", err=True)
+
+    if regressions:
+        raise SystemExit(1)
+
+
+@bench.command("cold-start")
+@click.option("--profile", default="production", help="Configuration profile to start")
+@click.option("--path", default="/users", help="First request to serve")
+@click.option("--runs", type=int, default=5)
+def cold_start_command(profile, path, runs):
+    """Time import-to-first-request in fresh interpreters"""
+
+    result = cold_start(profile, path, runs)
+
+    for key in ("import_ms", "create_ms", "first_request_ms", "process_ms"):
+        click.echo(f"{key:<18} {result[key]:>8.1f}")
+
+
+@bench.command("async")
+@click.option("--requests", type=int, default=500)
+@click.option("--connections", type=int, default=5, help="Database connections for each app")
+@click.option("--concurrency", type=int, default=50, help="Requests in flight on the async app")
+@click.option("--seed", type=int, default=0)
+def async_command(requests, connections, concurrency, seed):
+    """Compare read-route throughput of the sync and async apps"""
+
+    result = throughput(requests, connections, concurrency, seed)
+
+    for name, rps in result.items():
+        click.echo(f"{name:<6} {rps:>8.1f} req/s")
@@ -10,27 +10,71 @@ CREATE TABLE users
     id SERIAL PRIMARY KEY,
     first_name TEXT NOT NULL,
     last_name TEXT NOT NULL,
-    image_url TEXT
+    image_url TEXT,
+    post_count INT NOT NULL DEFAULT 0,
+    updated_at TIMESTAMP NOT NULL DEFAULT (now() AT TIME ZONE 'utc'),
+    deleted_at TIMESTAMP
 );
 
+CREATE INDEX ix_users_name_order ON users (last_name, first_name, id);
+CREATE INDEX ix_users_post_count ON users (post_count, id);
+CREATE INDEX ix_users_deleted ON users (deleted_at) WHERE deleted_at IS NOT NULL;
+
 CREATE TABLE posts
 (
     id SERIAL PRIMARY KEY,
     title TEXT NOT NULL,
     content TEXT NOT NULL,
+    content_html TEXT,
+    render_version INT NOT NULL DEFAULT 0,
     created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-    user_id INT REFERENCES users
+    updated_at TIMESTAMP NOT NULL DEFAULT (now() AT TIME ZONE 'utc'),
+    user_id INT REFERENCES users,
+    search_vector TSVECTOR,
+    deleted_at TIMESTAMP
 );
 
+CREATE INDEX ix_posts_search ON posts USING GIN (search_vector);
+CREATE INDEX ix_posts_created ON posts (created_at, id);
+CREATE INDEX ix_posts_deleted ON posts (deleted_at) WHERE deleted_at IS NOT NULL;
+
 CREATE TABLE tags
 (
     id SERIAL PRIMARY KEY,
-    name TEXT UNIQUE NOT NULL
+    name TEXT NOT NULL,
+    post_count INT NOT NULL DEFAULT 0,
+    updated_at TIMESTAMP NOT NULL DEFAULT (now() AT TIME ZONE 'utc'),
+    deleted_at TIMESTAMP
 );
 
+CREATE INDEX ix_tags_name_order ON tags (name, id);
+CREATE INDEX ix_tags_post_count ON tags (post_count, id);
+CREATE UNIQUE INDEX uq_tags_live_name ON tags (name) WHERE deleted_at IS NULL;
+CREATE INDEX ix_tags_deleted ON tags (deleted_at) WHERE deleted_at IS NOT NULL;
+CREATE INDEX ix_tags_name_prefix ON tags (lower(name) text_pattern_ops);
+
 CREATE TABLE post_tag
 (
     post_id INT REFERENCES posts,
     tag_id INT REFERENCES tags,
     PRIMARY KEY(post_id, tag_id)
-);
\ No newline at end of file
+);
+
+CREATE INDEX ix_post_tag_tag ON post_tag (tag_id, post_id);
+
+CREATE TABLE related_posts
+(
+    post_id INT REFERENCES posts,
+    rank SMALLINT,
+    related_id INT NOT NULL REFERENCES posts,
+    score DOUBLE PRECISION NOT NULL,
+    PRIMARY KEY(post_id, rank)
+);
+
+CREATE INDEX ix_related_posts_related ON related_posts (related_id);
+
+CREATE TABLE cache_versions
+(
+    name TEXT PRIMARY KEY,
+    version INT NOT NULL DEFAULT 0
+);
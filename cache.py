@@ -0,0 +1,268 @@
+"""Rendered page caches for Blogly.
+
+Cached pages are keyed on their row's ETag, which moves with updated_at
+(see models.Timestamped), so a write from any process or `flask` command
+makes the old copy unreachable everywhere without invalidating anything.
+Superseded copies age out by LRU eviction or FRAGMENT_CACHE_TTL. With
+several worker processes the memory backend keeps one copy per process;
+the redis backend shares them."""
+
+import heapq
+import threading
+import time
+from bisect import bisect_left
+from collections import OrderedDict, namedtuple
+
+
+class NullCache:
+    """Cache backend that stores nothing"""
+
+    def get(self, key):
+        return None
+
+    def set(self, key, value):
+        pass
+
+    def clear(self):
+        pass
+
+
+class LRUCache:
+    """In-process cache bounded by entry count and time-to-live"""
+
+    def __init__(self, maxsize=1024, ttl=300):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __repr__(self):
+        """Show info about cache"""
+
+        c = self
+        return f"<LRUCache {len(c._entries)}/{c.maxsize} ttl={c.ttl}>"
+
+    def get(self, key):
+        """Return the cached value for key, or None if missing or expired"""
+
+        with self._lock:
+            entry = self._entries.get(key)
+
+            if entry is None:
+                return None
+
+            expires, value = entry
+
+            if expires < time.monotonic():
+                del self._entries[key]
+                return None
+
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        """Store value under key, evicting the least recently used entry when full"""
+
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl, value)
+            self._entries.move_to_end(key)
+
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+class RedisCache:
+    """Cache shared between worker processes, backed by Redis"""
+
+    def __init__(self, url, ttl=300, prefix="blogly:fragment:"):
+        import redis
+
+        self.client = redis.Redis.from_url(url)
+        self.ttl = ttl
+        self.prefix = prefix
+
+    def __repr__(self):
+        """Show info about cache"""
+
+        return f"<RedisCache {self.prefix} ttl={self.ttl}>"
+
+    def get(self, key):
+        value = self.client.get(self.prefix + key)
+        return None if value is None else value.decode()
+
+    def set(self, key, value):
+        self.client.set(self.prefix + key, value, ex=self.ttl)
+
+    def clear(self):
+        for key in self.client.scan_iter(self.prefix + "*"):
+            self.client.delete(key)
+
+
+class FragmentCache:
+    """Cache of rendered post, profile and tag pages, keyed by the entity
+    they show and the version of it they show"""
+
+    def __init__(self):
+        self.backend = LRUCache()
+
+    def init_app(self, app):
+        """Pick the backend named by FRAGMENT_CACHE_BACKEND (memory, redis or null)"""
+
+        kind = app.config.get("FRAGMENT_CACHE_BACKEND", "memory")
+        ttl = app.config.get("FRAGMENT_CACHE_TTL", 300)
+
+        if kind == "memory":
+            self.backend = LRUCache(app.config.get("FRAGMENT_CACHE_SIZE", 1024), ttl)
+        elif kind == "redis":
+            self.backend = RedisCache(app.config["FRAGMENT_CACHE_URL"], ttl)
+        elif kind == "null":
+            self.backend = NullCache()
+        else:
+            raise ValueError(f"Unknown FRAGMENT_CACHE_BACKEND {kind!r}")
+
+    def cached(self, key, render):
+        """Return the page stored under key, calling render() to build it on a miss"""
+
+        html = self.backend.get(key)
+
+        if html is None:
+            html = render()
+            self.backend.set(key, html)
+
+        return html
+
+    async def cached_async(self, key, render):
+        """cached() for a coroutine function render"""
+
+        html = self.backend.get(key)
+
+        if html is None:
+            html = await render()
+            self.backend.set(key, html)
+
+        return html
+
+    def clear(self):
+        self.backend.clear()
+
+
+TagSnapshot = namedtuple("TagSnapshot", "version tags names trie")
+
+
+def usage_order(tag):
+    """Sort key for suggestions: most used first, then by name"""
+
+    return (-tag.post_count, tag.name, tag.id)
+
+
+class TagTrie:
+    """Answers the most used tags whose names start with a prefix, ignoring
+    case. The first cached_depth levels of the trie are flattened into a
+    dict from each short prefix to its top tags, since short prefixes match
+    the most tags; longer prefixes bisect a sorted list of names, where the
+    matches are few enough to rank per request."""
+
+    def __init__(self, tags, top=50, cached_depth=3):
+        self.size = top
+        self.depth = cached_depth
+
+        entries = sorted((tag.name.lower(), usage_order(tag), tag) for tag in tags)
+        self.names = [name for name, _, _ in entries]
+        self.tags = [tag for _, _, tag in entries]
+
+        matches = {}
+
+        for name, _, tag in entries:
+            for length in range(1, min(len(name), cached_depth) + 1):
+                matches.setdefault(name[:length], []).append(tag)
+
+        self.tops = {prefix: heapq.nsmallest(top, found, key=usage_order)
+                     for prefix, found in matches.items()}
+
+    def __repr__(self):
+        """Show info about trie"""
+
+        return f"<TagTrie tags={len(self.tags)} top={self.size}>"
+
+    def suggest(self, prefix, limit=10):
+        """Up to limit (at most top) tags whose names start with prefix, most used first"""
+
+        prefix = prefix.lower()
+        limit = min(limit, self.size)
+
+        if len(prefix) <= self.depth:
+            return self.tops.get(prefix, [])[:limit]
+
+        start = bisect_left(self.names, prefix)
+        end = bisect_left(self.names, prefix + "\U0010ffff", start)
+
+        return heapq.nsmallest(limit, self.tags[start:end], key=usage_order)
+
+
+class TagCatalog:
+    """Process-local snapshot of every tag, sorted by name.
+
+    load() returns (id, name, post_count) rows and probe() returns a
+    version counter shared by all worker processes. Each read costs one
+    probe; the full tag list is only re-fetched after the counter moves,
+    that is when a tag is created, renamed or removed. The post counts
+    that rank suggestions are as of that re-fetch."""
+
+    def __init__(self, load, probe):
+        self.load = load
+        self.probe = probe
+        self.snapshot = TagSnapshot(None, [], {}, TagTrie([]))
+
+    def __repr__(self):
+        """Show info about catalog"""
+
+        c = self.snapshot
+        return f"<TagCatalog v{c.version} {len(c.tags)} tags>"
+
+    def get(self):
+        """Return the current TagSnapshot, re-fetching it if another request
+        or process has changed the tags since it was taken"""
+
+        snapshot = self.snapshot
+        version = self.probe()
+
+        if version == snapshot.version:
+            return snapshot
+
+        return self.store(version, self.load())
+
+    def store(self, version, rows):
+        """Replace the snapshot with (id, name, post_count) rows read at version"""
+
+        tags = sorted(rows, key=lambda tag: (tag.name, tag.id))
+        snapshot = TagSnapshot(version,
+                               tags,
+                               {tag.id: tag.name for tag in tags},
+                               TagTrie(tags))
+        self.snapshot = snapshot
+
+        return snapshot
+
+    def invalidate(self):
+        """Force the next get() to re-fetch"""
+
+        self.snapshot = TagSnapshot(None, [], {}, TagTrie([]))
+
+
+def post_key(id, version):
+    return f"post:{id}:{version}"
+
+
+def user_key(id, version):
+    return f"user:{id}:{version}"
+
+
+def tag_key(id, version):
+    return f"tag:{id}:{version}"
+
+
+fragment_cache = FragmentCache()
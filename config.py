@@ -0,0 +1,88 @@
+"""Configuration profiles for Blogly.
+
+create_app() takes one of these by name (or the class itself); the
+BLOGLY_CONFIG environment variable picks the profile when none is given.
+DATABASE_URL, DATABASE_REPLICA_URLS, the DB_POOL_* settings and
+SECRET_KEY override the defaults in every profile."""
+
+import os
+
+
+class Config:
+    """Settings shared by every profile"""
+
+    SQLALCHEMY_DATABASE_URI = os.environ.get("DATABASE_URL", "postgresql:///blogly")
+    SQLALCHEMY_TRACK_MODIFICATIONS = False
+    SQLALCHEMY_ECHO = False
+    SQLALCHEMY_ENGINE_OPTIONS = {
+        "pool_size": int(os.environ.get("DB_POOL_SIZE", 5)),
+        "max_overflow": int(os.environ.get("DB_MAX_OVERFLOW", 10)),
+        "pool_timeout": int(os.environ.get("DB_POOL_TIMEOUT", 30)),
+        "pool_recycle": int(os.environ.get("DB_POOL_RECYCLE", 1800)),
+        "pool_pre_ping": True,
+    }
+
+    # Comma-separated replica URIs; GET requests read from these
+    SQLALCHEMY_REPLICA_URIS = [uri for uri in os.environ.get("DATABASE_REPLICA_URLS", "").split(",")
+                               if uri]
+    # How long a client reads from the primary after it writes
+    READ_YOUR_WRITES_SECONDS = 10
+
+    SECRET_KEY = os.environ.get("SECRET_KEY", "SECRET!")
+
+    DEBUG_TB_ENABLED = False
+    DEBUG_TB_INTERCEPT_REDIRECTS = False
+
+    USERS_PER_PAGE = 50
+    TAGS_PER_PAGE = 50
+    MAX_PER_PAGE = 200
+    SEARCH_PER_PAGE = 20
+    FEED_PER_PAGE = 20
+    # /tags/suggest: default and largest ?limit=, and whether to answer from
+    # the per-process tag trie ("catalog") or a prefix query ("database")
+    TAG_SUGGEST_LIMIT = 10
+    MAX_TAG_SUGGEST_LIMIT = 50
+    TAG_SUGGEST_SOURCE = os.environ.get("TAG_SUGGEST_SOURCE", "catalog")
+    MAX_BATCH_POSTS = 1000
+
+    FRAGMENT_CACHE_BACKEND = "memory"
+    FRAGMENT_CACHE_SIZE = 1024
+    FRAGMENT_CACHE_TTL = 300
+
+    METRICS_ENABLED = True
+
+    # Deletes only mark rows; purge.py removes them in throttled batches,
+    # on a thread in each app process unless `flask purge` runs instead
+    PURGE_IN_PROCESS = True
+    PURGE_BATCH_SIZE = 500
+    PURGE_PAUSE_SECONDS = 0.05
+
+    # Part of every ETag; change it when templates change so clients refetch
+    ETAG_VERSION = os.environ.get("ETAG_VERSION", "1")
+
+
+class DevelopmentConfig(Config):
+    """Local development: SQL echo and the debug toolbar"""
+
+    DEBUG = True
+    SQLALCHEMY_ECHO = True
+    DEBUG_TB_ENABLED = True
+
+
+class ProductionConfig(Config):
+    """Serving traffic: no echo, no toolbar"""
+
+
+class TestingConfig(Config):
+    """test_flask.py: a separate database"""
+
+    TESTING = True
+    PURGE_IN_PROCESS = False
+    SQLALCHEMY_DATABASE_URI = os.environ.get("TEST_DATABASE_URL", "postgresql:///blogly_test")
+
+
+PROFILES = {
+    "development": DevelopmentConfig,
+    "production": ProductionConfig,
+    "testing": TestingConfig,
+}
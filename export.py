@@ -0,0 +1,113 @@
+"""Streaming exports of Blogly data as NDJSON or CSV.
+
+Rows are read through a server-side cursor in batches of BATCH_SIZE and
+written out batch by batch, so memory stays flat however big the table is."""
+
+import csv
+import io
+import json
+from datetime import datetime
+
+from sqlalchemy import select
+
+from models import db, User, Post, Tag, PostTag
+
+BATCH_SIZE = 1000
+
+KINDS = ("users", "posts", "tags", "post_tags")
+FORMATS = {"ndjson": "application/x-ndjson", "csv": "text/csv"}
+
+
+def export_statement(kind, user_id=None, since=None, until=None):
+    """Build the projection for one export kind, filtered by author and
+    post creation time where those apply"""
+
+    if kind == "users":
+        stmt = select(User.id, User.first_name, User.last_name, User.image_url).order_by(User.id)
+
+        if user_id is not None:
+            stmt = stmt.where(User.id == user_id)
+
+        return stmt
+
+    if kind == "tags":
+        return select(Tag.id, Tag.name).order_by(Tag.id)
+
+    if kind == "posts":
+        stmt = (select(Post.id, Post.user_id, Post.title, Post.content, Post.created_at)
+                .order_by(Post.id))
+    elif kind == "post_tags":
+        stmt = (select(PostTag.post_id, PostTag.tag_id, Tag.name.label("tag"))
+                .join(Tag, Tag.id == PostTag.tag_id)
+                .join(Post, Post.id == PostTag.post_id)
+                .order_by(PostTag.post_id, PostTag.tag_id))
+    else:
+        raise ValueError(f"Unknown export kind {kind!r}")
+
+    if user_id is not None:
+        stmt = stmt.where(Post.user_id == user_id)
+
+    if since is not None:
+        stmt = stmt.where(Post.created_at >= since)
+
+    if until is not None:
+        stmt = stmt.where(Post.created_at < until)
+
+    return stmt
+
+
+def stream_rows(stmt):
+    """Yield lists of row mappings, BATCH_SIZE at a time, off a server-side cursor"""
+
+    result = db.session.execute(stmt.execution_options(stream_results=True))
+
+    for batch in result.mappings().partitions(BATCH_SIZE):
+        yield batch
+
+
+def to_json(value):
+    if isinstance(value, datetime):
+        return value.isoformat()
+
+    raise TypeError(f"Cannot serialize {type(value).__name__}")
+
+
+def ndjson_chunks(stmt):
+    """Yield NDJSON text, one chunk per batch of rows"""
+
+    for batch in stream_rows(stmt):
+        yield "".join(json.dumps(dict(row), default=to_json) + "\n" for row in batch)
+
+
+def csv_chunks(stmt):
+    """Yield CSV text with a header line, one chunk per batch of rows"""
+
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+
+    writer.writerow([column.name for column in stmt.selected_columns])
+    yield buffer.getvalue()
+
+    for batch in stream_rows(stmt):
+        buffer.seek(0)
+        buffer.truncate()
+
+        for row in batch:
+            writer.writerow([value.isoformat() if isinstance(value, datetime) else value
+                             for value in row.values()])
+
+        yield buffer.getvalue()
+
+
+def export_chunks(kind, fmt, user_id=None, since=None, until=None):
+    """Generator of text chunks for kind in fmt (ndjson or csv)"""
+
+    stmt = export_statement(kind, user_id, since, until)
+
+    if fmt == "ndjson":
+        return ndjson_chunks(stmt)
+
+    if fmt == "csv":
+        return csv_chunks(stmt)
+
+    raise ValueError(f"Unknown export format {fmt!r}")
@@ -0,0 +1,244 @@
+"""Bulk import of users, tags, posts and post tags from NDJSON or CSV.
+
+Rows are keyed on natural keys (user and post ids from the source, tag
+names) and conflicting rows are skipped, so re-running an import is a
+no-op. On Postgres each file is COPYed into a temporary staging table and
+merged with one INSERT ... SELECT; on SQLite rows go in as executemany
+batches. Search indexing is deferred until every row is in."""
+
+import csv
+import io
+import json
+import time
+from datetime import datetime
+
+from sqlalchemy import text
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+
+import search
+from models import db, User, Post, Tag, PostTag, CacheVersion
+
+# Load order matters: posts need their users, links need posts and tags
+KINDS = ("users", "tags", "posts", "post_tags")
+
+COLUMNS = {
+    "users": ("id", "first_name", "last_name", "image_url"),
+    "tags": ("name",),
+    "posts": ("id", "user_id", "title", "content", "created_at"),
+    "post_tags": ("post_id", "tag"),
+}
+
+INTEGER_COLUMNS = {"id", "user_id", "post_id"}
+
+STAGING = {
+    "users": "id INT, first_name TEXT, last_name TEXT, image_url TEXT",
+    "tags": "name TEXT",
+    "posts": "id INT, user_id INT, title TEXT, content TEXT, created_at TIMESTAMP",
+    "post_tags": "post_id INT, tag TEXT",
+}
+
+MERGE = {
+    "users": ["INSERT INTO users (id, first_name, last_name, image_url, updated_at) "
+              "SELECT id, first_name, last_name, COALESCE(image_url, ''), "
+              "now() AT TIME ZONE 'utc' FROM import_users "
+              "ON CONFLICT (id) DO NOTHING"],
+    "tags": ["INSERT INTO tags (name, updated_at) "
+             "SELECT DISTINCT name, now() AT TIME ZONE 'utc' FROM import_tags "
+             "ON CONFLICT (name) WHERE deleted_at IS NULL DO NOTHING"],
+    "posts": ["INSERT INTO posts (id, user_id, title, content, created_at, updated_at) "
+              "SELECT id, user_id, title, content, COALESCE(created_at, now() AT TIME ZONE 'utc'), "
+              "now() AT TIME ZONE 'utc' FROM import_posts "
+              "ON CONFLICT (id) DO NOTHING"],
+    "post_tags": ["INSERT INTO tags (name, updated_at) "
+                  "SELECT DISTINCT tag, now() AT TIME ZONE 'utc' FROM import_post_tags "
+                  "WHERE tag IS NOT NULL "
+                  "ON CONFLICT (name) WHERE deleted_at IS NULL DO NOTHING",
+                  "INSERT INTO post_tag (post_id, tag_id) "
+                  "SELECT DISTINCT s.post_id, t.id FROM import_post_tags s "
+                  "JOIN tags t ON t.name = s.tag AND t.deleted_at IS NULL "
+                  "JOIN posts p ON p.id = s.post_id AND p.deleted_at IS NULL "
+                  "ON CONFLICT DO NOTHING"],
+}
+
+
+def read_records(path):
+    """Yield dicts from an NDJSON (.ndjson/.jsonl) or CSV (.csv) file"""
+
+    with open(path, newline="") as file:
+        if path.endswith(".csv"):
+            yield from csv.DictReader(file)
+        else:
+            for line in file:
+                if line.strip():
+                    yield json.loads(line)
+
+
+def batched(records, size):
+    batch = []
+
+    for record in records:
+        batch.append(record)
+
+        if len(batch) == size:
+            yield batch
+            batch = []
+
+    if batch:
+        yield batch
+
+
+def normalize(kind, record):
+    """Pick kind's columns out of record and coerce CSV strings to column types"""
+
+    row = {}
+
+    for column in COLUMNS[kind]:
+        value = record.get(column)
+
+        if value == "":
+            value = None
+        elif value is not None and column in INTEGER_COLUMNS:
+            value = int(value)
+        elif isinstance(value, str) and column == "created_at":
+            value = datetime.fromisoformat(value)
+
+        row[column] = value
+
+    return row
+
+
+def import_records(kind, records, batch_size=5000, progress=None):
+    """Load records of kind. Calls progress(kind, rows, seconds) after each
+    batch and returns the number of rows read. Caller commits."""
+
+    started = time.perf_counter()
+    count = 0
+
+    if db.session.bind.dialect.name == "postgresql":
+        copy = begin_copy(kind)
+        load = lambda rows: copy(rows)
+    else:
+        load = lambda rows: insert_batch(kind, rows)
+
+    for batch in batched(records, batch_size):
+        load([normalize(kind, record) for record in batch])
+        count += len(batch)
+
+        if progress:
+            progress(kind, count, time.perf_counter() - started)
+
+    if db.session.bind.dialect.name == "postgresql":
+        for statement in MERGE[kind]:
+            db.session.execute(text(statement))
+
+        if kind in ("users", "posts"):
+            db.session.execute(text(
+                f"SELECT setval(pg_get_serial_sequence('{kind}', 'id'), "
+                f"COALESCE(MAX(id), 1)) FROM {kind}"))
+
+    return count
+
+
+def begin_copy(kind):
+    """Create kind's staging table and return a function that COPYs a batch into it"""
+
+    db.session.execute(text("SET LOCAL synchronous_commit TO OFF"))
+    db.session.execute(text(
+        f"CREATE TEMP TABLE IF NOT EXISTS import_{kind} ({STAGING[kind]}) ON COMMIT DROP"))
+
+    cursor = db.session.connection().connection.cursor()
+    columns = COLUMNS[kind]
+
+    def copy(rows):
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+
+        for row in rows:
+            writer.writerow([row[column] for column in columns])
+
+        buffer.seek(0)
+        cursor.copy_expert(
+            f"COPY import_{kind} ({', '.join(columns)}) FROM STDIN WITH (FORMAT csv)",
+            buffer)
+
+    return copy
+
+
+def insert_batch(kind, rows):
+    """Insert one batch with executemany, skipping rows whose natural key exists"""
+
+    if kind == "users":
+        for row in rows:
+            row["image_url"] = row["image_url"] or ""
+
+        insert_ignoring(User.__table__, rows)
+
+    elif kind == "tags":
+        insert_ignoring(Tag.__table__, rows)
+
+    elif kind == "posts":
+        for row in rows:
+            row["created_at"] = row["created_at"] or datetime.utcnow()
+
+        insert_ignoring(Post.__table__, rows)
+
+    elif kind == "post_tags":
+        # Links without a tag name are skipped, like links to unknown posts
+        rows = [row for row in rows if row["tag"] is not None]
+        names = {row["tag"] for row in rows}
+        insert_ignoring(Tag.__table__, [dict(name=name) for name in names])
+
+        tag_ids = dict(db.session.query(Tag.name, Tag.id).filter(Tag.name.in_(names)))
+        post_ids = {post_id for (post_id,) in
+                    db.session.query(Post.id).filter(Post.id.in_({row["post_id"] for row in rows}))}
+
+        links = {(row["post_id"], tag_ids[row["tag"]])
+                 for row in rows if row["post_id"] in post_ids and row["tag"] in tag_ids}
+
+        insert_ignoring(PostTag.__table__, [dict(post_id=post_id, tag_id=tag_id)
+                                            for post_id, tag_id in links])
+
+
+def insert_ignoring(table, rows):
+    if rows:
+        db.session.execute(sqlite_insert(table).on_conflict_do_nothing(), rows)
+
+
+def import_files(paths, batch_size=5000, progress=None):
+    """Import {kind: path} in dependency order, one transaction per kind.
+    Returns {kind: rows read}."""
+
+    counts = {}
+
+    for kind in KINDS:
+        if paths.get(kind):
+            counts[kind] = import_records(kind, read_records(paths[kind]), batch_size, progress)
+            db.session.commit()
+
+    finish_import(counts)
+
+    return counts
+
+
+def finish_import(counts):
+    """Index work deferred until the rows are in: search vectors for new
+    posts, the tag catalog version, page timestamps and post counts"""
+
+    if "posts" in counts:
+        search.index_missing(db.session)
+        # Profiles list their posts
+        User.touch_all()
+
+    if "tags" in counts or "post_tags" in counts:
+        CacheVersion.bump("tags")
+
+    if "post_tags" in counts:
+        # Post and tag pages list each other
+        Post.touch_all()
+        Tag.touch_all()
+
+    if "posts" in counts or "post_tags" in counts:
+        User.reconcile_post_counts()
+        Tag.reconcile_post_counts()
+
+    db.session.commit()
@@ -0,0 +1,209 @@
+"""SQL statement counting and request metrics for Blogly."""
+
+import threading
+import time
+from bisect import bisect_left
+
+from flask import g, request, has_request_context, before_render_template, template_rendered
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+
+class QueryCounter:
+    """Records every SQL statement run on engine while the block is active
+
+        with QueryCounter(db.engine) as queries:
+            client.get('/users')
+        queries.count
+    """
+
+    def __init__(self, engine):
+        self.engine = engine
+        self.statements = []
+
+    def __repr__(self):
+        """Show info about counter"""
+
+        return f"<QueryCounter {self.count} statements>"
+
+    def __enter__(self):
+        event.listen(self.engine, "before_cursor_execute", self.record)
+        return self
+
+    def __exit__(self, *exc):
+        event.remove(self.engine, "before_cursor_execute", self.record)
+
+    def record(self, conn, cursor, statement, parameters, context, executemany):
+        self.statements.append(statement)
+
+    @property
+    def count(self):
+        return len(self.statements)
+
+
+class Histogram:
+    """Cumulative Prometheus-style histogram"""
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def lines(self, name, labels):
+        cumulative = 0
+
+        for bound, count in zip(self.buckets + (float("inf"),), self.counts):
+            cumulative += count
+            le = "+Inf" if bound == float("inf") else repr(bound)
+            yield f'{name}_bucket{{{labels},le="{le}"}} {cumulative}'
+
+        yield f"{name}_sum{{{labels}}} {self.sum!r}"
+        yield f"{name}_count{{{labels}}} {self.count}"
+
+
+class RequestTimer:
+    """Timings gathered while one request runs"""
+
+    __slots__ = ("started", "queries", "db", "render", "render_started")
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.queries = 0
+        self.db = 0.0
+        self.render = 0.0
+        self.render_started = None
+
+
+SECONDS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+STATEMENTS = (0, 1, 2, 3, 5, 10, 20, 50, 100)
+
+METRICS = {
+    "blogly_request_duration_seconds": ("Total time spent handling requests", SECONDS),
+    "blogly_db_duration_seconds": ("Time spent in SQL statements per request", SECONDS),
+    "blogly_render_duration_seconds": ("Time spent rendering templates per request", SECONDS),
+    "blogly_db_statements": ("SQL statements run per request", STATEMENTS),
+}
+
+
+class Metrics:
+    """Always-on request instrumentation.
+
+    Hooks SQLAlchemy cursor events and Flask template signals to time SQL
+    and rendering inside each request, adds a Server-Timing header to the
+    response and keeps per-endpoint histograms for render_prometheus().
+    The per-statement cost is two perf_counter() calls and a dict lookup."""
+
+    def __init__(self):
+        self.histograms = {}
+        self._lock = threading.Lock()
+
+    def __repr__(self):
+        """Show info about metrics"""
+
+        return f"<Metrics {len(self.histograms)} series>"
+
+    def init_app(self, app):
+        if not app.config.get("METRICS_ENABLED", True):
+            return
+
+        if not event.contains(Engine, "before_cursor_execute", self.before_cursor_execute):
+            event.listen(Engine, "before_cursor_execute", self.before_cursor_execute)
+            event.listen(Engine, "after_cursor_execute", self.after_cursor_execute)
+
+        before_render_template.connect(self.before_render, app)
+        template_rendered.connect(self.after_render, app)
+        app.before_request(self.start_request)
+        app.after_request(self.finish_request)
+
+    # Hooks
+
+    def start_request(self):
+        g.request_timer = RequestTimer()
+
+    def before_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault("query_started", []).append(time.perf_counter())
+
+    def after_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        elapsed = time.perf_counter() - conn.info["query_started"].pop()
+        timer = g.get("request_timer") if has_request_context() else None
+
+        if timer is not None:
+            timer.queries += 1
+            timer.db += elapsed
+
+    def before_render(self, sender, template, context, **extra):
+        timer = g.get("request_timer")
+
+        if timer is not None:
+            timer.render_started = time.perf_counter()
+
+    def after_render(self, sender, template, context, **extra):
+        timer = g.get("request_timer")
+
+        if timer is not None and timer.render_started is not None:
+            timer.render += time.perf_counter() - timer.render_started
+            timer.render_started = None
+
+    def finish_request(self, response):
+        timer = g.pop("request_timer", None)
+
+        if timer is None:
+            return response
+
+        total = time.perf_counter() - timer.started
+
+        response.headers["Server-Timing"] = (
+            f'db;dur={timer.db * 1000:.2f};desc="{timer.queries} queries", '
+            f"render;dur={timer.render * 1000:.2f}, "
+            f"total;dur={total * 1000:.2f}")
+
+        endpoint = request.endpoint or "unmatched"
+        self.observe(endpoint, {
+            "blogly_request_duration_seconds": total,
+            "blogly_db_duration_seconds": timer.db,
+            "blogly_render_duration_seconds": timer.render,
+            "blogly_db_statements": timer.queries,
+        })
+
+        return response
+
+    # Histograms
+
+    def observe(self, endpoint, values):
+        with self._lock:
+            for name, value in values.items():
+                histogram = self.histograms.get((name, endpoint))
+
+                if histogram is None:
+                    histogram = self.histograms[(name, endpoint)] = Histogram(METRICS[name][1])
+
+                histogram.observe(value)
+
+    def render_prometheus(self):
+        """All histograms in the Prometheus text exposition format"""
+
+        lines = []
+
+        with self._lock:
+            for name, (help, buckets) in METRICS.items():
+                lines.append(f"# HELP {name} {help}")
+                lines.append(f"# TYPE {name} histogram")
+
+                for (metric, endpoint), histogram in sorted(self.histograms.items()):
+                    if metric == name:
+                        lines.extend(histogram.lines(name, f'endpoint="{endpoint}"'))
+
+        return "\n".join(lines) + "\n"
+
+    def reset(self):
+        with self._lock:
+            self.histograms.clear()
+
+
+metrics = Metrics()
@@ -0,0 +1,35 @@
+"""Markdown rendering of post content.
+
+Posts are rendered once when they are written and the sanitized HTML is
+stored with the RENDERER_VERSION that produced it, so post pages do no
+parsing. Bump RENDERER_VERSION whenever the output would change (new
+extensions, different allowed tags) and run `flask render-posts` to
+re-render the rows written by older versions."""
+
+import bleach
+import markdown
+
+RENDERER_VERSION = 1
+
+EXTENSIONS = ["fenced_code", "tables", "sane_lists"]
+
+ALLOWED_TAGS = {"a", "abbr", "b", "blockquote", "br", "code", "em", "h1", "h2", "h3",
+                "h4", "h5", "h6", "hr", "i", "li", "ol", "p", "pre", "strong",
+                "table", "tbody", "td", "th", "thead", "tr", "ul"}
+ALLOWED_ATTRIBUTES = {"a": ["href", "title"], "abbr": ["title"], "th": ["align"],
+                      "td": ["align"]}
+
+
+def render_content(text):
+    """Markdown text as HTML that is safe to insert into a page"""
+
+    html = markdown.markdown(text, extensions=EXTENSIONS)
+
+    return bleach.clean(html, tags=ALLOWED_TAGS, attributes=ALLOWED_ATTRIBUTES,
+                        protocols={"http", "https", "mailto"}, strip=True)
+
+
+def render_batch(rows):
+    """[(id, content_html)] for [(id, content)]; runs in a worker process"""
+
+    return [(id, render_content(content)) for id, content in rows]
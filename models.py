@@ -1,24 +1,149 @@
 """Models for Blogly."""
 
 from enum import unique
-from flask_sqlalchemy import SQLAlchemy
-from sqlalchemy.orm import backref
+from collections import Counter, namedtuple
+from sqlalchemy import DDL, bindparam, event, func, literal, select, text, tuple_
+from sqlalchemy.orm import backref, Session, with_loader_criteria
+from sqlalchemy.sql import Select
 from sqlalchemy.sql.schema import ForeignKey
 from datetime import datetime
+from cache import TagCatalog
+from pagination import keyset_page, keyset_window
+from markup import render_content, render_batch, RENDERER_VERSION
+import search
+from routing import RoutingSQLAlchemy
 
-db = SQLAlchemy()
+db = RoutingSQLAlchemy()
 
 def connect_db(app):
     """Connect to database"""
     
-    db.app = app
     db.init_app(app)
 
-class User(db.Model):
+class Timestamped:
+    """updated_at for conditional GETs. It moves whenever anything the
+    row's page shows changes, including rows of other tables."""
+
+    updated_at = db.Column(db.DateTime,
+                           nullable=False,
+                           default=datetime.utcnow,
+                           onupdate=datetime.utcnow)
+
+    @classmethod
+    def touch(self, ids):
+        """Sets updated_at to now on rows ids, a collection or a select of
+        ids, with one UPDATE. Caller commits."""
+
+        if not isinstance(ids, Select):
+            ids = list(ids)
+
+            if not ids:
+                return
+
+        (self.query
+         .filter(self.id.in_(ids))
+         .update({self.updated_at: datetime.utcnow()}, synchronize_session=False))
+
+    @classmethod
+    def touch_all(self):
+        """Sets updated_at to now on every row. Caller commits."""
+
+        self.query.update({self.updated_at: datetime.utcnow()}, synchronize_session=False)
+
+
+class SoftDeleted:
+    """deleted_at marks a row as deleted. SELECTs skip marked rows (see
+    exclude_deleted) and purge.py removes them for good in the background."""
+
+    deleted_at = db.Column(db.DateTime)
+
+    @classmethod
+    def mark_deleted(self, *criteria, **values):
+        """Sets deleted_at to now, plus any values, on the live rows matching
+        criteria with one UPDATE. Caller commits."""
+
+        (self.query
+         .filter(self.deleted_at.is_(None), *criteria)
+         .update({self.deleted_at: datetime.utcnow(), **values}, synchronize_session=False))
+
+    @classmethod
+    def deleted_ids(self, limit, *criteria):
+        """Ids of up to limit marked rows, for the purge"""
+
+        return [id for (id,) in
+                db.session.execute(select(self.id)
+                                   .where(self.deleted_at.isnot(None), *criteria)
+                                   .order_by(self.id)
+                                   .limit(limit)
+                                   .execution_options(include_deleted=True))]
+
+
+@event.listens_for(Session, "do_orm_execute")
+def exclude_deleted(state):
+    """Filters soft-deleted rows out of every ORM SELECT, including joins and
+    relationship loads, unless it runs with execution_options(include_deleted=True)"""
+
+    # Relationship and column loads inherit the criteria from the statement that started them
+    if (state.is_select and not state.is_relationship_load and not state.is_column_load
+            and not state.execution_options.get("include_deleted", False)):
+        state.statement = state.statement.options(
+            with_loader_criteria(SoftDeleted, lambda cls: cls.deleted_at.is_(None),
+                                 include_aliases=True))
+
+
+def purge_index(table):
+    """Partial index that lets the purge find marked rows without a scan"""
+
+    where = text("deleted_at IS NOT NULL")
+
+    return db.Index(f"ix_{table}_deleted", "deleted_at",
+                    postgresql_where=where, sqlite_where=where)
+
+
+class PostCounted:
+    """post_count kept exact by the write paths, so list pages can show
+    and sort by it without counting. Deleted posts don't count."""
+
+    post_count = db.Column(db.Integer,
+                           nullable=False,
+                           default=0,
+                           server_default="0")
+
+    @classmethod
+    def adjust_post_counts(self, deltas):
+        """Adds {id: delta} to post_count with one executemany UPDATE. Caller commits."""
+
+        rows = [dict(row_id=id, delta=delta) for id, delta in deltas.items() if delta]
+
+        if rows:
+            table = self.__table__
+            db.session.execute(table.update()
+                               .where(table.c.id == bindparam("row_id"))
+                               .values(post_count=table.c.post_count + bindparam("delta")),
+                               rows)
+
+    @classmethod
+    def reconcile_post_counts(self):
+        """Recounts every row's posts with one set-based UPDATE that only
+        writes rows which drifted; returns how many did. Caller commits."""
+
+        actual = self.counted_posts()
+
+        return (self.query
+                .filter(self.post_count != actual)
+                .update({self.post_count: actual}, synchronize_session=False))
+
+
+class User(Timestamped, PostCounted, SoftDeleted, db.Model):
     """User model class"""
 
     __tablename__ = "users"
 
+    # Back keyset pagination of the user directory in each sort order
+    __table_args__ = (db.Index("ix_users_name_order", "last_name", "first_name", "id"),
+                      db.Index("ix_users_post_count", "post_count", "id"),
+                      purge_index("users"))
+
     id = db.Column(db.Integer,
                    primary_key=True,
                    autoincrement=True)
@@ -53,27 +178,45 @@ class User(db.Model):
             self.image_url = image_url
 
         db.session.add(self)
+        # Post pages show the author's name
+        Post.touch(select(Post.id).where(Post.user_id == self.id))
         db.session.commit()
 
     def full_name(self):
         return f"{self.first_name} {self.last_name}"
 
+    @classmethod
+    def counted_posts(self):
+        return (select(func.count(Post.id))
+                .where(Post.user_id == User.id, Post.deleted_at.is_(None))
+                .scalar_subquery())
+
     @classmethod
     def remove_user(self, id):
-        """Removes user and all posts from database"""
+        """Marks user and all their posts deleted in a single transaction"""
 
-        Post.remove_user_posts(id)
+        post_ids = select(Post.id).where(Post.user_id == id, Post.deleted_at.is_(None))
+        tag_counts = PostTag.tag_counts_for(post_ids)
+        tag_ids = list(tag_counts)
 
-        self.query.filter_by(id=id).delete()
+        RelatedPost.touch_lists(post_ids)
+        Post.mark_deleted(Post.user_id == id)
+        self.mark_deleted(self.id == id, post_count=0)
+        Tag.touch(tag_ids)
+        Tag.adjust_post_counts({tag_id: -n for tag_id, n in tag_counts.items()})
 
         db.session.commit()
 
 
-class Post(db.Model):
+class Post(Timestamped, SoftDeleted, db.Model):
     """Post model class"""
 
     __tablename__ = "posts"
 
+    # Backs keyset pagination of the newest-first feeds
+    __table_args__ = (db.Index("ix_posts_created", "created_at", "id"),
+                      purge_index("posts"))
+
     id = db.Column(db.Integer,
                    primary_key=True,
                    autoincrement=True)
@@ -83,6 +226,14 @@ class Post(db.Model):
     
     content = db.Column(db.Text,
                         nullable=False)
+
+    # content rendered by markup.render_content, and the RENDERER_VERSION that did it
+    content_html = db.Column(db.Text)
+
+    render_version = db.Column(db.Integer,
+                               nullable=False,
+                               default=0,
+                               server_default="0")
     
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     
@@ -98,6 +249,13 @@ class Post(db.Model):
 
         p = self
         return f"<Post {p.id} {p.title} {p.created_at}>"
+
+    def set_content(self, content):
+        """Sets content and renders it, so reads never parse Markdown"""
+
+        self.content = content
+        self.content_html = render_content(content)
+        self.render_version = RENDERER_VERSION
     
     def update(self, title, content):
         """Update user info with new values"""
@@ -106,40 +264,262 @@ class Post(db.Model):
             self.title = title
         
         if (content):
-            self.content = content
+            self.set_content(content)
+
+        # Profile and tag pages list the post's title
+        tag_ids = PostTag.tag_ids_for([self.id])
 
         db.session.add(self)
+        db.session.flush()
+        search.index_posts(db.session, [self.id])
+        User.touch([self.user_id])
+        Tag.touch(tag_ids)
+        RelatedPost.touch_lists([self.id])
         db.session.commit()
     
     @classmethod
-    def remove_post(self, id):
-        """Removes post from database, and returns author's ID number"""
+    def create(self, user_id, title, content, tag_ids=()):
+        """Adds a post and its links to the live tags among tag_ids in one
+        transaction, returns the post's id"""
+
+        [id] = self.insert_many([dict(user_id=user_id, title=title, content=content,
+                                      tags=Tag.live_ids(tag_ids))])
+        db.session.commit()
+
+        return id
+
+    @classmethod
+    def create_many(self, items):
+        """Validates items and adds them as posts with their tag links in one
+        transaction. Returns (ids, errors); when any item is invalid nothing
+        is written and errors holds {"index": i, "errors": {field: message}}
+        for each bad item."""
 
-        post = Post.query.filter_by(id=id)
-        user_id = Post.query.get_or_404(id).user_id
+        errors = self.validate_many(items)
 
-        PostTag.delete_posts(id)
+        if errors:
+            return [], errors
 
-        post.delete()
+        ids = self.insert_many(items)
         db.session.commit()
 
-        return user_id
+        return ids, []
 
     @classmethod
-    def remove_user_posts(self, user_id):
+    def validate_many(self, items):
+        """Checks each item has a known user_id, a title, content and a list of
+        known tag ids, with one query for all users and one for all tags"""
 
-        posts = Post.query.filter_by(user_id=user_id).all()
+        errors = {}
 
-        for post in posts:
-            Post.remove_post(post.id)
-    
+        def error(index, field, message):
+            errors.setdefault(index, {})[field] = message
+
+        def is_id(value):
+            return isinstance(value, int) and not isinstance(value, bool)
+
+        for index, item in enumerate(items):
+            if not isinstance(item, dict):
+                error(index, "item", "must be an object")
+                continue
+
+            if not is_id(item.get("user_id")):
+                error(index, "user_id", "must be an integer")
+
+            if not isinstance(item.get("title"), str) or not item["title"].strip():
+                error(index, "title", "must be a non-empty string")
+
+            if not isinstance(item.get("content"), str):
+                error(index, "content", "must be a string")
+
+            tags = item.get("tags", [])
+            if not isinstance(tags, list) or not all(is_id(tag_id) for tag_id in tags):
+                error(index, "tags", "must be a list of tag ids")
+
+        valid = [(index, item) for index, item in enumerate(items) if index not in errors]
+
+        user_ids = {item["user_id"] for _, item in valid}
+        known_users = {id for (id,) in db.session.query(User.id).filter(User.id.in_(user_ids))}
+
+        tag_ids = {tag_id for _, item in valid for tag_id in item.get("tags", [])}
+        known_tags = Tag.live_ids(tag_ids)
+
+        for index, item in valid:
+            if item["user_id"] not in known_users:
+                error(index, "user_id", f"no user {item['user_id']}")
+
+            unknown = sorted(set(item.get("tags", [])) - known_tags)
+            if unknown:
+                error(index, "tags", f"no tags {unknown}")
+
+        return [dict(index=index, errors=fields) for index, fields in sorted(errors.items())]
+
+    @classmethod
+    def insert_many(self, items):
+        """Inserts posts from dicts of user_id, title, content and tags (tag
+        ids), with one statement for the posts and one executemany for their
+        links, and indexes them for search. Returns the new ids. Caller commits."""
+
+        now = datetime.utcnow()
+        ids = self.insert_rows([dict(user_id=item["user_id"],
+                                     title=item["title"],
+                                     content=item["content"],
+                                     content_html=render_content(item["content"]),
+                                     render_version=RENDERER_VERSION,
+                                     created_at=now,
+                                     updated_at=now)
+                                for item in items])
+        links = {(id, int(tag_id)) for id, item in zip(ids, items)
+                 for tag_id in item.get("tags", ())}
+
+        if links:
+            db.session.execute(PostTag.__table__.insert(),
+                               [dict(post_id=post_id, tag_id=tag_id) for post_id, tag_id in links])
+
+        search.index_posts(db.session, ids)
+        User.touch({item["user_id"] for item in items})
+        Tag.touch({tag_id for _, tag_id in links})
+        User.adjust_post_counts(Counter(item["user_id"] for item in items))
+        Tag.adjust_post_counts(Counter(tag_id for _, tag_id in links))
+
+        return ids
+
+    @classmethod
+    def insert_rows(self, rows):
+        """Inserts post rows with one statement and returns their ids in
+        order. Caller commits."""
+
+        table = self.__table__
+
+        if db.session.bind.dialect.name == "postgresql":
+            return list(db.session.execute(
+                table.insert().values(rows).returning(table.c.id)).scalars())
+
+        # SQLite has no RETURNING here. The insert takes the write lock until
+        # commit and gives each row max(id) + 1, so the ids are the last ones.
+        db.session.execute(table.insert(), rows)
+        last = (db.session.query(func.max(Post.id))
+                .execution_options(include_deleted=True)
+                .scalar())
+
+        return list(range(last - len(rows) + 1, last + 1))
+
+    @classmethod
+    def feed(self, after=None, before=None, per_page=20, tag_id=None):
+        """One Page of FeedItems, newest first, optionally only tag_id's posts.
+        Reads just the listed columns: one query for the page, one for its tags."""
+
+        columns = (Post.created_at, Post.id)
+        query = (select(Post.id, Post.title, Post.created_at, Post.user_id,
+                        User.first_name, User.last_name)
+                 .outerjoin(User, Post.user_id == User.id))
+
+        if tag_id is not None:
+            query = query.join(PostTag, (PostTag.post_id == Post.id) & (PostTag.tag_id == tag_id))
+
+        rows = db.session.execute(
+            keyset_window(query, columns, after, before, per_page, descending=True)).all()
+        page = keyset_page(rows, columns, after, before, per_page)
+
+        tags = {}
+        ids = [row.id for row in page]
+
+        if ids:
+            links = db.session.execute(
+                select(PostTag.post_id, Tag.id, Tag.name)
+                .join(Tag, Tag.id == PostTag.tag_id)
+                .where(PostTag.post_id.in_(ids))
+                .order_by(Tag.name))
+
+            for post_id, id, name in links:
+                tags.setdefault(post_id, []).append((id, name))
+
+        page.items = [FeedItem(row.id, row.title, row.created_at, row.user_id,
+                               row.first_name and f"{row.first_name} {row.last_name}",
+                               tags.get(row.id, []))
+                      for row in page]
+
+        return page
+
+    @classmethod
+    def render_stale(self, batch_size=1000, chunk_size=100, map=map):
+        """Re-renders posts whose content_html an older RENDERER_VERSION made.
+        Each batch is split into chunks for map, which can be a process
+        pool's, and written with one executemany UPDATE and a commit.
+        Returns how many posts were rendered."""
+
+        table = self.__table__
+        write = (table.update()
+                 .where(table.c.id == bindparam("row_id"),
+                        # A post edited meanwhile already has current HTML
+                        table.c.render_version != RENDERER_VERSION)
+                 .values(content_html=bindparam("html"),
+                         render_version=RENDERER_VERSION,
+                         updated_at=bindparam("now")))
+        last_id, total = 0, 0
+
+        while True:
+            rows = db.session.execute(
+                select(Post.id, Post.content)
+                .where(Post.render_version != RENDERER_VERSION, Post.id > last_id)
+                .order_by(Post.id)
+                .limit(batch_size)).all()
+
+            if not rows:
+                return total
+
+            chunks = [[tuple(row) for row in rows[i:i + chunk_size]]
+                      for i in range(0, len(rows), chunk_size)]
+            now = datetime.utcnow()
+            rendered = [dict(row_id=id, html=html, now=now)
+                        for chunk in map(render_batch, chunks) for id, html in chunk]
+
+            db.session.execute(write, rendered)
+            db.session.commit()
+
+            last_id = rows[-1].id
+            total += len(rows)
+
+    @classmethod
+    def remove_post(self, id):
+        """Marks post deleted, and returns author's ID number"""
+
+        user_id = db.session.query(Post.user_id).filter_by(id=id).first_or_404().user_id
+        tag_ids = PostTag.tag_ids_for([id])
+
+        RelatedPost.touch_lists([id])
+        Post.mark_deleted(Post.id == id)
+        User.touch([user_id])
+        Tag.touch(tag_ids)
+        User.adjust_post_counts({user_id: -1})
+        Tag.adjust_post_counts({tag_id: -1 for tag_id in tag_ids})
+        db.session.commit()
+
+        return user_id
+
+
+
+search.install(Post.__table__)
 
+# A post as the feeds list it; tags holds (id, name) pairs
+FeedItem = namedtuple("FeedItem", "id title created_at user_id author tags")
 
-class Tag(db.Model):
+
+class Tag(Timestamped, PostCounted, SoftDeleted, db.Model):
     """Tag model class"""
 
     __tablename__ = "tags"
 
+    # Back keyset pagination of the tag list in each sort order
+    __table_args__ = (db.Index("ix_tags_name_order", "name", "id"),
+                      db.Index("ix_tags_post_count", "post_count", "id"),
+                      # Names are unique among live tags, so a deleted
+                      # tag's name is free before the purge runs
+                      db.Index("uq_tags_live_name", "name", unique=True,
+                               postgresql_where=text("deleted_at IS NULL"),
+                               sqlite_where=text("deleted_at IS NULL")),
+                      purge_index("tags"))
+
     def __repr__(self):
         """Show tag representation"""
 
@@ -151,31 +531,131 @@ class Tag(db.Model):
                    autoincrement=True)
 
     name = db.Column(db.Text,
-                     nullable=False,
-                     unique=True)
+                     nullable=False)
 
     def update(self, name):
-        """Update user info with new values"""
+        """Update tag with new name"""
 
         self.name = name
 
         db.session.add(self)
+        # Post pages list their tags' names
+        Post.touch(select(PostTag.post_id).where(PostTag.tag_id == self.id))
+        CacheVersion.bump("tags")
         db.session.commit()
+
+    @classmethod
+    def counted_posts(self):
+        return (select(func.count(PostTag.post_id))
+                .join(Post, Post.id == PostTag.post_id)
+                .where(PostTag.tag_id == Tag.id, Post.deleted_at.is_(None))
+                .scalar_subquery())
     
     @classmethod
     def remove_tag(self, id):
-        """Removes all tags from database"""
+        """Marks tag deleted; its post links go with the purge"""
 
-        PostTag.delete_tags(id)
-        Tag.query.filter_by(id=id).delete()
+        Tag.mark_deleted(Tag.id == id, post_count=0)
+        Post.touch(select(PostTag.post_id).where(PostTag.tag_id == id))
+        CacheVersion.bump("tags")
+        db.session.commit()
+
+    @classmethod
+    def live_ids(self, ids):
+        """The ids among ids of tags that exist and are not deleted"""
+
+        ids = {int(id) for id in ids}
+
+        if not ids:
+            return set()
+
+        return {id for (id,) in db.session.query(Tag.id).filter(Tag.id.in_(ids))}
+
+    @classmethod
+    def name_taken(self, name, except_ids=()):
+        """Whether a live tag other than except_ids is called name"""
+
+        return db.session.query(
+            Tag.query
+            .filter(Tag.name == name, Tag.deleted_at.is_(None), Tag.id.notin_(except_ids))
+            .exists()).scalar()
+
+    @classmethod
+    def merge(self, target_id, source_ids, name=None):
+        """Moves the posts of tags source_ids onto tag target_id, optionally
+        renaming it, and marks the sources deleted. The name must be free
+        among live tags other than the sources (see name_taken). Runs the
+        same few set-based statements in one transaction however many posts
+        move. Returns the ids of the sources merged."""
+
+        sources = [id for (id,) in db.session.query(Tag.id)
+                   .filter(Tag.id.in_(source_ids), Tag.id != target_id)]
+
+        if not (sources or name):
+            return []
+
+        links = PostTag.__table__
+        moved = select(links.c.post_id).where(links.c.tag_id.in_(sources))
+        tagged = select(links.c.post_id).where(links.c.tag_id == target_id)
+
+        # Post pages list their tags' names
+        (Post.query
+         .filter(Post.id.in_(moved))
+         .update({Post.updated_at: datetime.utcnow()}, synchronize_session=False))
+
+        # Posts that already carry the target keep that link, the rest gain one
+        db.session.execute(links.insert().from_select(
+            ["post_id", "tag_id"],
+            select(links.c.post_id, literal(target_id))
+            .where(links.c.tag_id.in_(sources), links.c.post_id.notin_(tagged))
+            .distinct()))
+        db.session.execute(links.delete().where(links.c.tag_id.in_(sources)))
+
+        # Before the rename, so the target can take a source's name
+        Tag.mark_deleted(Tag.id.in_(sources), post_count=0)
+
+        values = {Tag.post_count: Tag.counted_posts(), Tag.updated_at: datetime.utcnow()}
+
+        if name:
+            values[Tag.name] = name
+
+        Tag.query.filter_by(id=target_id).update(values, synchronize_session=False)
+        CacheVersion.bump("tags")
         db.session.commit()
-        
+
+        return sources
+
+    @classmethod
+    def suggest(self, prefix, limit):
+        """Up to limit live tags whose names start with prefix, ignoring case,
+        most used first. The database side of tag_catalog's trie."""
+
+        pattern = (prefix.lower()
+                   .replace("\\", "\\\\")
+                   .replace("%", "\\%")
+                   .replace("_", "\\_")) + "%"
+
+        return (db.session.query(Tag.id, Tag.name, Tag.post_count)
+                .filter(func.lower(Tag.name).like(pattern, escape="\\"))
+                .order_by(Tag.post_count.desc(), Tag.name, Tag.id)
+                .limit(limit)
+                .all())
+
+
+# Lets Tag.suggest's LIKE 'prefix%' use an index whatever the collation
+event.listen(Tag.__table__, "after_create",
+             DDL("CREATE INDEX ix_tags_name_prefix ON tags (lower(name) text_pattern_ops)")
+             .execute_if(dialect="postgresql"))
+
 
 class PostTag(db.Model):
     """Model class for linking Tag and Post models"""
 
     __tablename__ = "post_tag"
 
+    # The primary key leads with post_id; this serves lookups by tag
+    __table_args__ = (db.Index("ix_post_tag_tag", "tag_id", "post_id"),)
+
     def __repr__(self):
 
         pt = self
@@ -190,38 +670,199 @@ class PostTag(db.Model):
                        primary_key=True)
     
     @classmethod
-    def delete_tags(self, tag_id):
-        """Delete relevant tags in post_tag table"""
+    def tag_ids_for(self, post_ids):
+        """Returns ids of tags linked to any of post_ids"""
+
+        if not post_ids:
+            return []
+
+        query = (db.session.query(PostTag.tag_id)
+                 .filter(PostTag.post_id.in_(post_ids))
+                 .distinct())
+
+        return [tag_id for (tag_id,) in query]
 
-        PostTag.query.filter_by(tag_id=tag_id).delete()
-        db.session.commit()
-    
     @classmethod
-    def delete_posts(self, post_id):
-        """Delete relevant posts in post_tag table"""
+    def tag_counts_for(self, post_ids):
+        """Returns {tag id: how many of post_ids (a collection or a select
+        of ids) carry it}"""
 
-        PostTag.query.filter_by(post_id=post_id).delete()
-        db.session.commit()
+        if not isinstance(post_ids, Select) and not post_ids:
+            return {}
+
+        query = (db.session.query(PostTag.tag_id, func.count())
+                 .filter(PostTag.post_id.in_(post_ids))
+                 .group_by(PostTag.tag_id))
+
+        return dict(query.all())
 
     @classmethod
-    def update_tags(self, post_id, tag_ids):
-        """Deletes current tag-post associations, 
-        and adds list of tag_ids to table via add_tags method"""
+    def delete_links(self, column, ids, limit):
+        """Deletes up to limit links whose column (post_id or tag_id) is in ids
+        and returns how many went. Caller commits."""
 
-        PostTag.query.filter_by(post_id=post_id).delete()
+        table = self.__table__
+        batch = (select(table.c.post_id, table.c.tag_id)
+                 .where(table.c[column.key].in_(ids))
+                 .limit(limit))
+
+        return db.session.execute(
+            table.delete().where(tuple_(table.c.post_id, table.c.tag_id).in_(batch))).rowcount
+
+    @classmethod
+    def update_tags(self, post_id, tag_ids):
+        """Replaces the post's tags with the live tags among tag_ids in one
+        transaction, writing only the links that were added or removed.
+        Links to deleted tags are left to the purge."""
+
+        current = {tag_id for (tag_id,) in
+                   db.session.query(PostTag.tag_id)
+                   .join(Tag, Tag.id == PostTag.tag_id)
+                   .filter(PostTag.post_id == post_id, Tag.deleted_at.is_(None))}
+        wanted = Tag.live_ids(tag_ids)
+
+        removed = current - wanted
+        added = wanted - current
+
+        if not (removed or added):
+            return
+
+        if removed:
+            (PostTag.query
+             .filter(PostTag.post_id == post_id, PostTag.tag_id.in_(removed))
+             .delete(synchronize_session=False))
+
+        if added:
+            db.session.execute(PostTag.__table__.insert(),
+                               [dict(post_id=post_id, tag_id=tag_id) for tag_id in added])
+
+        Post.touch([post_id])
+        Tag.touch(removed | added)
+        Tag.adjust_post_counts({**{tag_id: -1 for tag_id in removed},
+                                **{tag_id: 1 for tag_id in added}})
         db.session.commit()
 
-        PostTag.add_tags(post_id, tag_ids)
+
+class RelatedPost(db.Model):
+    """A post's top related posts by shared tags, written by related.rebuild_related()"""
+
+    __tablename__ = "related_posts"
+
+    # The purge looks rows up by the post they recommend
+    __table_args__ = (db.Index("ix_related_posts_related", "related_id"),)
+
+    def __repr__(self):
+
+        rp = self
+        return f"<RelatedPost {rp.post_id} #{rp.rank} {rp.related_id}>"
+
+    post_id = db.Column(db.Integer,
+                        db.ForeignKey("posts.id"),
+                        primary_key=True)
+
+    rank = db.Column(db.SmallInteger,
+                     primary_key=True,
+                     autoincrement=False)
+
+    related_id = db.Column(db.Integer,
+                           db.ForeignKey("posts.id"),
+                           nullable=False)
+
+    score = db.Column(db.Float,
+                      nullable=False)
+
+    @classmethod
+    def for_post(self, post_id):
+        """Returns (id, title) of post_id's live related posts, best first"""
+
+        return (db.session.query(Post.id, Post.title)
+                .join(RelatedPost, RelatedPost.related_id == Post.id)
+                .filter(RelatedPost.post_id == post_id)
+                .order_by(RelatedPost.rank)
+                .all())
+
+    @classmethod
+    def lists_for(self, post_ids):
+        """Returns {post id: [related ids, best first]} for those of post_ids that have any"""
+
+        lists = {}
+        query = (db.session.query(RelatedPost.post_id, RelatedPost.related_id)
+                 .filter(RelatedPost.post_id.in_(post_ids))
+                 .order_by(RelatedPost.post_id, RelatedPost.rank))
+
+        for post_id, related_id in query:
+            lists.setdefault(post_id, []).append(related_id)
+
+        return lists
+
+    @classmethod
+    def replace(self, post_ids, rows):
+        """Replaces the lists of post_ids with rows of (post_id, rank,
+        related_id, score). Caller commits."""
+
+        if post_ids:
+            table = self.__table__
+            db.session.execute(table.delete().where(table.c.post_id.in_(post_ids)))
+
+            if rows:
+                db.session.execute(table.insert(),
+                                   [dict(post_id=post_id, rank=rank, related_id=related_id,
+                                         score=score)
+                                    for post_id, rank, related_id, score in rows])
+
+    @classmethod
+    def touch_lists(self, related_ids):
+        """Touches the posts whose lists show any of related_ids (a collection
+        or a select of ids), whose pages list their titles. Caller commits."""
+
+        Post.touch(select(RelatedPost.post_id).where(RelatedPost.related_id.in_(related_ids)))
 
     @classmethod
-    def add_tags(self, post_id, tag_ids):
-        """Adds tag entries for new post of id post_id.
-        Same as update_tags method except it does not delete any entries in database."""
+    def delete_for(self, post_ids):
+        """Deletes the lists of post_ids and their entries in other lists. Caller commits."""
+
+        table = self.__table__
+        db.session.execute(table.delete().where(table.c.post_id.in_(post_ids) |
+                                                table.c.related_id.in_(post_ids)))
+
+
+class CacheVersion(db.Model):
+    """Shared version counters that tell every worker process when to
+    refresh its in-process copy of a rarely changing table"""
+
+    __tablename__ = "cache_versions"
+
+    def __repr__(self):
+
+        cv = self
+        return f"<CacheVersion {cv.name} {cv.version}>"
+
+    name = db.Column(db.Text,
+                     primary_key=True)
+
+    version = db.Column(db.Integer,
+                        nullable=False,
+                        default=0)
+
+    @classmethod
+    def current(self, name):
+        """Returns the counter for name, 0 if it was never bumped"""
+
+        return db.session.query(CacheVersion.version).filter_by(name=name).scalar() or 0
+
+    @classmethod
+    def bump(self, name):
+        """Increments the counter for name. Caller commits, so the bump
+        lands in the same transaction as the write it announces."""
+
+        updated = (CacheVersion.query
+                   .filter_by(name=name)
+                   .update({CacheVersion.version: CacheVersion.version + 1},
+                           synchronize_session=False))
+
+        if not updated:
+            db.session.add(CacheVersion(name=name, version=1))
 
-        to_add = []
 
-        for tag_id in tag_ids:
-            to_add.append(PostTag(post_id=post_id, tag_id=tag_id))
-            
-        db.session.add_all(to_add)
-        db.session.commit()
\ No newline at end of file
+tag_catalog = TagCatalog(load=lambda: db.session.query(Tag.id, Tag.name, Tag.post_count).all(),
+                         probe=lambda: CacheVersion.current("tags"))
@@ -0,0 +1,139 @@
+"""Keyset (cursor) pagination for Blogly list pages."""
+
+import base64
+import json
+from datetime import datetime
+
+from sqlalchemy import tuple_
+from werkzeug.exceptions import BadRequest
+
+
+class Page:
+    """One page of results plus opaque cursors to its neighbours"""
+
+    def __init__(self, items, next_cursor=None, prev_cursor=None):
+        self.items = items
+        self.next_cursor = next_cursor
+        self.prev_cursor = prev_cursor
+
+    def __repr__(self):
+        """Show info about page"""
+
+        p = self
+        return f"<Page {len(p.items)} items next={p.next_cursor} prev={p.prev_cursor}>"
+
+    def __iter__(self):
+        return iter(self.items)
+
+    def __len__(self):
+        return len(self.items)
+
+    @property
+    def has_next(self):
+        return self.next_cursor is not None
+
+    @property
+    def has_prev(self):
+        return self.prev_cursor is not None
+
+
+def encode_cursor(values):
+    """Encode a tuple of sort-key values into an opaque, URL-safe cursor"""
+
+    data = [{"dt": v.isoformat()} if isinstance(v, datetime) else v
+            for v in values]
+    raw = json.dumps(data, separators=(",", ":")).encode()
+
+    return base64.urlsafe_b64encode(raw).decode().rstrip("=")
+
+
+def decode_value(value):
+    """One value of a decoded cursor: a scalar, or {"dt": ...} for a datetime.
+    Raises ValueError for anything else, which no sort key holds."""
+
+    if isinstance(value, dict) and value.keys() == {"dt"}:
+        return datetime.fromisoformat(value["dt"])
+
+    if value is None or isinstance(value, (str, int, float)):
+        return value
+
+    raise ValueError(f"not a sort-key value: {value!r}")
+
+
+def decode_cursor(cursor, size):
+    """Decode a cursor made by encode_cursor back into a tuple of values.
+    Raises BadRequest if the cursor is malformed."""
+
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+        data = json.loads(raw)
+        values = tuple(map(decode_value, data)) if isinstance(data, list) else ()
+    except (ValueError, TypeError):
+        raise BadRequest("Invalid page cursor")
+
+    if len(values) != size:
+        raise BadRequest("Invalid page cursor")
+
+    return values
+
+
+def keyset_paginate(query, columns, after=None, before=None, per_page=20,
+                    descending=False, key=None):
+    """Return a Page of query results ordered by columns.
+
+    columns must form a unique sort key (end with the primary key) and should
+    be backed by an index, so that every page costs one index range scan no
+    matter how deep it is. after/before are cursors taken from a previous
+    Page. key maps a result row to its sort-key values and defaults to
+    reading each column's attribute off the row."""
+
+    rows = keyset_window(query, columns, after, before, per_page, descending).all()
+
+    return keyset_page(rows, columns, after, before, per_page, key)
+
+
+def keyset_window(query, columns, after=None, before=None, per_page=20, descending=False):
+    """Filter, order and limit a Query or select() to the rows of one page,
+    plus one to tell whether there is another. Run it, then hand the rows
+    to keyset_page with the same arguments."""
+
+    # Walking backwards flips both the comparison and the order,
+    # then keyset_page reverses the rows back into display order.
+    backwards = before is not None and after is None
+    cursor = before if backwards else after
+    reverse = descending != backwards
+
+    if cursor is not None:
+        values = decode_cursor(cursor, len(columns))
+        row_key = tuple_(*columns)
+        query = query.filter(row_key < tuple_(*values) if reverse
+                             else row_key > tuple_(*values))
+
+    order = [c.desc() if reverse else c.asc() for c in columns]
+
+    return query.order_by(*order).limit(per_page + 1)
+
+
+def keyset_page(rows, columns, after=None, before=None, per_page=20, key=None):
+    """Build the Page for rows fetched with keyset_window"""
+
+    if key is None:
+        names = [c.key for c in columns]
+        key = lambda row: tuple(getattr(row, n) for n in names)
+
+    backwards = before is not None and after is None
+
+    more = len(rows) > per_page
+    rows = list(rows[:per_page])
+
+    if backwards:
+        rows.reverse()
+        has_next, has_prev = True, more
+    else:
+        has_next, has_prev = more, after is not None
+
+    next_cursor = encode_cursor(key(rows[-1])) if rows and has_next else None
+    prev_cursor = encode_cursor(key(rows[0])) if rows and has_prev else None
+
+    return Page(rows, next_cursor, prev_cursor)
+
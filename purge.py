@@ -0,0 +1,99 @@
+"""Background removal of soft-deleted rows.
+
+The delete routes only mark rows (models.SoftDeleted), so they finish
+in one short transaction however much a user or tag owns. purge() then
+deletes the marked posts, tags and users and their post_tag links in
+batches of at most batch_size rows, committing and sleeping between
+batches so it never holds locks long enough to stall foreground
+requests. Run it with `flask purge`, or set PURGE_IN_PROCESS and
+purge_worker runs it on a background thread after each delete."""
+
+import time
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock
+
+from flask import current_app
+from sqlalchemy import exists
+
+import search
+from models import db, User, Post, Tag, PostTag, RelatedPost
+
+
+def purge(batch_size=500, pause=0.05):
+    """Delete every soft-deleted row and its links; returns {table: rows deleted}"""
+
+    counts = dict(posts=0, tags=0, users=0, post_tag=0)
+
+    def commit():
+        db.session.commit()
+        time.sleep(pause)
+
+    # Posts first, so the users whose posts they were have none left
+    steps = [(Post, PostTag.post_id, ()),
+             (Tag, PostTag.tag_id, ()),
+             (User, None, (~exists().where(Post.user_id == User.id),))]
+
+    for model, link, criteria in steps:
+        while True:
+            ids = model.deleted_ids(batch_size, *criteria)
+
+            if not ids:
+                break
+
+            while link is not None:
+                deleted = PostTag.delete_links(link, ids, batch_size)
+                counts["post_tag"] += deleted
+                commit()
+
+                if deleted < batch_size:
+                    break
+
+            if model is Post:
+                search.unindex_posts(db.session, ids)
+                RelatedPost.delete_for(ids)
+
+            counts[model.__tablename__] += (model.query
+                                            .filter(model.id.in_(ids))
+                                            .delete(synchronize_session=False))
+            commit()
+
+    return counts
+
+
+class PurgeWorker:
+    """Runs purge() on one background thread, at most one run queued at a time"""
+
+    def __init__(self):
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="purge")
+        self.queued = None
+        self.lock = Lock()
+
+    def __repr__(self):
+        """Show info about worker"""
+
+        return f"<PurgeWorker queued={self.queued}>"
+
+    def schedule(self):
+        """Queue a purge for the current app if it has PURGE_IN_PROCESS, unless
+        one is already waiting to start and will see the rows marked so far"""
+
+        app = current_app._get_current_object()
+
+        if not app.config["PURGE_IN_PROCESS"]:
+            return
+
+        with self.lock:
+            if self.queued is None or self.queued.running() or self.queued.done():
+                self.queued = self.executor.submit(self.run, app)
+
+    def run(self, app):
+        with app.app_context():
+            try:
+                purge(app.config["PURGE_BATCH_SIZE"], app.config["PURGE_PAUSE_SECONDS"])
+            except Exception:
+                app.logger.exception("Purge failed")
+            finally:
+                db.session.remove()
+
+
+purge_worker = PurgeWorker()
@@ -0,0 +1,121 @@
+"""Related posts by shared tags.
+
+rebuild_related() loads every live post-tag link into a sparse post x tag matrix
+and scores each pair of posts by the tags they share, weighting each tag
+by its inverse document frequency so that a rare tag in common counts for
+more than a popular one. Scores come from one sparse matrix product per
+batch of posts, and each post's top few are kept in related_posts, where
+view_post reads them with one indexed lookup. Only the lists that changed
+are written, and their posts touched, so re-running it after a few edits
+is cheap. Run it with `flask related-posts`; recommendations are as of
+the last run."""
+
+import numpy as np
+from scipy import sparse
+
+from models import db, Post, Tag, PostTag, RelatedPost
+
+
+def tag_matrix(links):
+    """(post ids, tag ids, post x tag CSR matrix) for (post_id, tag_id) links"""
+
+    links = np.asarray(links, dtype=np.int64).reshape(-1, 2)
+    post_ids, rows = np.unique(links[:, 0], return_inverse=True)
+    tag_ids, columns = np.unique(links[:, 1], return_inverse=True)
+    matrix = sparse.csr_matrix((np.ones(len(links), dtype=np.float32), (rows, columns)),
+                               shape=(len(post_ids), len(tag_ids)))
+
+    return post_ids, tag_ids, matrix
+
+
+def tag_weights(matrix, max_tag_share):
+    """Inverse document frequency of each tag column. Tags on one post relate
+    nothing, and tags on more than max_tag_share of posts relate too much to
+    be worth the work, so both weigh 0."""
+
+    posts = matrix.shape[0]
+    counts = np.asarray(matrix.sum(axis=0)).ravel()
+    weights = np.log(posts / np.maximum(counts, 1)).astype(np.float32)
+    weights[(counts < 2) | (counts > max(2, max_tag_share * posts))] = 0
+
+    return weights
+
+
+def top_related(left, right, start, stop, top):
+    """(rows, ranks, related rows, scores) of the top related posts of rows
+    start to stop, best first; ties go to the later row. left @ right is
+    the post x post score matrix."""
+
+    scores = (left[start:stop] @ right).tocoo()
+
+    rows, related, values = scores.row, scores.col, scores.data
+    keep = (related != rows + start) & (values > 0)
+    rows, related, values = rows[keep], related[keep], values[keep]
+
+    # By row, then by score and related row descending
+    order = np.lexsort((-related, -values, rows))
+    rows, related, values = rows[order], related[order], values[order]
+    ranks = np.arange(len(rows)) - np.searchsorted(rows, rows)
+    keep = ranks < top
+
+    return rows[keep] + start, ranks[keep], related[keep], values[keep]
+
+
+def rebuild_related(batch_size=1000, top=5, max_tag_share=0.1):
+    """Recomputes every post's related posts; returns how many lists changed"""
+
+    links = (db.session.query(PostTag.post_id, PostTag.tag_id)
+             .join(Post, Post.id == PostTag.post_id)
+             .join(Tag, Tag.id == PostTag.tag_id)
+             .filter(Post.deleted_at.is_(None), Tag.deleted_at.is_(None))
+             .all())
+    post_ids, _, matrix = tag_matrix(links)
+    changed = 0
+
+    if links:
+        weights = tag_weights(matrix, max_tag_share)
+        useful = matrix[:, weights > 0]
+        left = (useful @ sparse.diags(weights[weights > 0])).tocsr()
+        right = useful.T.tocsr()
+
+    for start in range(0, len(post_ids), batch_size):
+        stop = min(start + batch_size, len(post_ids))
+        batch = post_ids[start:stop].tolist()
+
+        found = {}
+
+        for row, rank, related, score in zip(*top_related(left, right, start, stop, top)):
+            found.setdefault(int(post_ids[row]), []).append(
+                (int(rank), int(post_ids[related]), float(score)))
+
+        current = RelatedPost.lists_for(batch)
+        stale = [post_id for post_id in batch
+                 if [related for _, related, _ in found.get(post_id, [])] !=
+                 current.get(post_id, [])]
+
+        changed += write(stale, [(post_id, *entry) for post_id in stale
+                                 for entry in found.get(post_id, [])])
+
+    # Posts that lost all their tags since the last run
+    tagged = set(post_ids.tolist())
+    untagged = [post_id for (post_id,) in db.session.query(RelatedPost.post_id).distinct()
+                if post_id not in tagged]
+
+    for start in range(0, len(untagged), batch_size):
+        changed += write(untagged[start:start + batch_size], [])
+
+    return changed
+
+
+def write(post_ids, rows):
+    """Stores post_ids' new lists and touches their pages in one transaction"""
+
+    if not post_ids:
+        return 0
+
+    RelatedPost.replace(post_ids, rows)
+    # Post pages show their related posts
+    Post.touch(post_ids)
+    db.session.commit()
+
+    return len(post_ids)
@@ -0,0 +1,96 @@
+"""Read/write routing between the primary database and read replicas.
+
+SQLALCHEMY_REPLICA_URIS become binds named replica_0, replica_1, ... and
+RoutingSession sends the reads of GET and HEAD requests to one of them.
+Everything else goes to the primary: flushes, INSERT/UPDATE/DELETE
+statements, other request methods and work outside a request (commands,
+tests, seed.py). A client that just wrote carries a short-lived cookie
+that keeps its reads on the primary until replicas have caught up, so
+the page it is redirected to shows its own change."""
+
+import random
+
+from flask import current_app, request, has_request_context
+from flask_sqlalchemy import SQLAlchemy, SignallingSession, get_state
+from sqlalchemy import orm
+from sqlalchemy.sql.dml import UpdateBase
+
+READ_METHODS = ("GET", "HEAD")
+STICKY_COOKIE = "blogly_primary"
+
+# Queue pool settings that SQLite's NullPool would reject
+QUEUE_POOL_OPTIONS = ("pool_size", "max_overflow", "pool_timeout")
+
+
+def replica_binds(app):
+    return [key for key in (app.config.get("SQLALCHEMY_BINDS") or {})
+            if key.startswith("replica_")]
+
+
+def reads_from_replica():
+    """Whether this request's reads may be served by a replica"""
+
+    return (has_request_context()
+            and request.method in READ_METHODS
+            and STICKY_COOKIE not in request.cookies)
+
+
+class RoutingSession(SignallingSession):
+    """Session that picks the primary or a replica for each statement"""
+
+    def __init__(self, db, **options):
+        super().__init__(db, **options)
+        self.replica = None
+
+    def get_bind(self, mapper=None, clause=None, **kw):
+        if self._flushing or isinstance(clause, UpdateBase) or not reads_from_replica():
+            return super().get_bind(mapper, clause)
+
+        if self.replica is None:
+            replicas = replica_binds(self.app)
+
+            if not replicas:
+                return super().get_bind(mapper, clause)
+
+            # One replica per session, so a request reads one consistent snapshot
+            self.replica = get_state(self.app).db.get_engine(self.app, random.choice(replicas))
+
+        return self.replica
+
+
+class RoutingSQLAlchemy(SQLAlchemy):
+    """SQLAlchemy extension with replica binds, read routing and
+    SQLALCHEMY_ENGINE_OPTIONS that also work on SQLite"""
+
+    def init_app(self, app):
+        binds = dict(app.config.get("SQLALCHEMY_BINDS") or {})
+
+        for n, uri in enumerate(app.config.get("SQLALCHEMY_REPLICA_URIS") or ()):
+            binds[f"replica_{n}"] = uri
+
+        app.config["SQLALCHEMY_BINDS"] = binds or None
+
+        super().init_app(app)
+
+        if binds:
+            app.after_request(stick_to_primary)
+
+    def create_session(self, options):
+        return orm.sessionmaker(class_=RoutingSession, db=self, **options)
+
+    def create_engine(self, sa_url, engine_opts):
+        if sa_url.drivername.startswith("sqlite"):
+            engine_opts = {option: value for option, value in engine_opts.items()
+                           if option not in QUEUE_POOL_OPTIONS}
+
+        return super().create_engine(sa_url, engine_opts)
+
+
+def stick_to_primary(response):
+    """After a write, read from the primary for READ_YOUR_WRITES_SECONDS"""
+
+    if request.method not in READ_METHODS:
+        response.set_cookie(STICKY_COOKIE, "1", httponly=True, samesite="Lax",
+                            max_age=current_app.config["READ_YOUR_WRITES_SECONDS"])
+
+    return response
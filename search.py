@@ -0,0 +1,190 @@
+"""Full-text search over posts.
+
+Postgres keeps a weighted tsvector column on posts behind a GIN index;
+SQLite keeps an FTS5 virtual table keyed by post id. Callers keep either
+one current with index_posts/unindex_posts inside their own transaction."""
+
+from collections import namedtuple
+
+from markupsafe import Markup, escape
+from sqlalchemy import DDL, bindparam, event, text
+
+from pagination import Page, encode_cursor, decode_cursor
+
+SearchHit = namedtuple("SearchHit", "id title rank snippet")
+
+# Control characters mark highlighted terms in raw snippets, so the
+# snippet can be HTML-escaped before the markers become <mark> tags
+MARK_START = "\x02"
+MARK_END = "\x03"
+
+# Titles weigh more than content in ranking
+POSTGRES_VECTOR = ("setweight(to_tsvector('english', title), 'A') || "
+                   "setweight(to_tsvector('english', content), 'B')")
+
+
+def install(table):
+    """Attach the search index DDL for each dialect to the posts table"""
+
+    for statement in ("ALTER TABLE posts ADD COLUMN search_vector tsvector",
+                      "CREATE INDEX ix_posts_search ON posts USING GIN (search_vector)"):
+        event.listen(table, "after_create",
+                     DDL(statement).execute_if(dialect="postgresql"))
+
+    event.listen(table, "after_create",
+                 DDL("CREATE VIRTUAL TABLE IF NOT EXISTS posts_fts "
+                     "USING fts5(title, content)").execute_if(dialect="sqlite"))
+    event.listen(table, "before_drop",
+                 DDL("DROP TABLE IF EXISTS posts_fts").execute_if(dialect="sqlite"))
+
+
+def dialect_of(session):
+    return session.bind.dialect.name
+
+
+def index_posts(session, post_ids):
+    """Bring the search index up to date for post_ids. Caller commits."""
+
+    if not post_ids:
+        return
+
+    post_ids = list(post_ids)
+
+    if dialect_of(session) == "postgresql":
+        session.execute(
+            text(f"UPDATE posts SET search_vector = {POSTGRES_VECTOR} "
+                 "WHERE id IN :ids").bindparams(bindparam("ids", expanding=True)),
+            {"ids": post_ids})
+    else:
+        unindex_posts(session, post_ids)
+        session.execute(
+            text("INSERT INTO posts_fts (rowid, title, content) "
+                 "SELECT id, title, content FROM posts "
+                 "WHERE id IN :ids").bindparams(bindparam("ids", expanding=True)),
+            {"ids": post_ids})
+
+
+def unindex_posts(session, post_ids):
+    """Drop post_ids from the search index. Caller commits.
+    Postgres needs nothing here; the vector goes with the row."""
+
+    if not post_ids or dialect_of(session) == "postgresql":
+        return
+
+    session.execute(
+        text("DELETE FROM posts_fts WHERE rowid IN :ids").bindparams(
+            bindparam("ids", expanding=True)),
+        {"ids": list(post_ids)})
+
+
+def reindex_all(session):
+    """Rebuild the whole search index with one set-based statement per dialect.
+    Caller commits."""
+
+    if dialect_of(session) == "postgresql":
+        session.execute(text(f"UPDATE posts SET search_vector = {POSTGRES_VECTOR}"))
+    else:
+        session.execute(text("DELETE FROM posts_fts"))
+        session.execute(text("INSERT INTO posts_fts (rowid, title, content) "
+                             "SELECT id, title, content FROM posts"))
+
+
+def index_missing(session):
+    """Index every post that is not in the search index yet, such as rows
+    written by a bulk import. Caller commits."""
+
+    if dialect_of(session) == "postgresql":
+        session.execute(text(f"UPDATE posts SET search_vector = {POSTGRES_VECTOR} "
+                             "WHERE search_vector IS NULL"))
+    else:
+        session.execute(text("INSERT INTO posts_fts (rowid, title, content) "
+                             "SELECT id, title, content FROM posts "
+                             "WHERE id NOT IN (SELECT rowid FROM posts_fts)"))
+
+
+POSTGRES_SEARCH = """
+WITH hits AS (
+    SELECT p.id, p.title, p.content,
+           ts_rank(p.search_vector, q)::float8 AS rank
+    FROM posts p, plainto_tsquery('english', :q) q
+    WHERE p.search_vector @@ q AND p.deleted_at IS NULL {tags}
+), page AS (
+    SELECT * FROM hits {cursor}
+    ORDER BY rank DESC, id DESC
+    LIMIT :limit
+)
+SELECT id, title, rank,
+       ts_headline('english', content, plainto_tsquery('english', :q),
+                   'StartSel=' || chr(2) || ', StopSel=' || chr(3) || ', MaxFragments=2')
+           AS snippet
+FROM page
+ORDER BY rank DESC, id DESC
+"""
+
+SQLITE_SEARCH = """
+SELECT id, title, rank, snippet FROM (
+    SELECT posts.id AS id, posts.title AS title,
+           -bm25(posts_fts, 10.0, 1.0) AS rank,
+           snippet(posts_fts, 1, char(2), char(3), '...', 16) AS snippet
+    FROM posts_fts JOIN posts ON posts.id = posts_fts.rowid
+    WHERE posts_fts MATCH :q AND posts.deleted_at IS NULL {tags}
+) hits {cursor}
+ORDER BY rank DESC, id DESC
+LIMIT :limit
+"""
+
+
+def fts5_query(q):
+    """Quote each word so user input is never parsed as FTS5 syntax"""
+
+    return " ".join('"' + word.replace('"', '""') + '"' for word in q.split())
+
+
+def highlight(snippet):
+    """Escape a raw snippet and turn its match markers into <mark> tags"""
+
+    html = str(escape(snippet or ""))
+
+    return Markup(html.replace(MARK_START, "<mark>").replace(MARK_END, "</mark>"))
+
+
+def search_posts(session, q, tag_ids=(), after=None, per_page=20):
+    """Return a Page of SearchHits for q, best match first.
+
+    tag_ids limits hits to posts carrying any of those tags. Pages are
+    keyed on (rank, id), so later pages cost the same as the first."""
+
+    q = (q or "").strip()
+
+    if not q:
+        return Page([])
+
+    postgres = dialect_of(session) == "postgresql"
+    params = {"q": q if postgres else fts5_query(q), "limit": per_page + 1}
+
+    tags = ""
+    if tag_ids:
+        tags = "AND {}.id IN (SELECT post_id FROM post_tag WHERE tag_id IN :tag_ids)".format(
+            "p" if postgres else "posts")
+        params["tag_ids"] = [int(tag_id) for tag_id in tag_ids]
+
+    cursor = ""
+    if after is not None:
+        params["rank"], params["id"] = decode_cursor(after, 2)
+        cursor = "WHERE rank < :rank OR (rank = :rank AND id < :id)"
+
+    statement = text((POSTGRES_SEARCH if postgres else SQLITE_SEARCH)
+                     .format(tags=tags, cursor=cursor))
+    if tag_ids:
+        statement = statement.bindparams(bindparam("tag_ids", expanding=True))
+
+    rows = session.execute(statement, params).all()
+
+    hits = [SearchHit(row.id, row.title, row.rank, highlight(row.snippet))
+            for row in rows[:per_page]]
+
+    next_cursor = None
+    if len(rows) > per_page:
+        next_cursor = encode_cursor((hits[-1].rank, hits[-1].id))
+
+    return Page(hits, next_cursor)
@@ -0,0 +1,74 @@
+// Tag selector for the post forms: suggests tags from /tags/suggest as
+// the user types and adds the chosen ones as checked checkboxes named
+// after the selector's data-field.
+
+document.querySelectorAll(".tag-selector").forEach(selector => {
+    const url = selector.dataset.suggestUrl;
+    const field = selector.dataset.field;
+    const checked = selector.querySelector(".tag-container");
+    const input = selector.querySelector("input[type=search]");
+    const list = selector.querySelector(".tag-suggestions");
+    let pending = null;
+
+    function addTag(tag) {
+        if (checked.querySelector(`#tag-${tag.id}`)) {
+            return;
+        }
+
+        const span = document.createElement("span");
+        span.className = "form-check";
+
+        const box = document.createElement("input");
+        box.className = "form-check-input";
+        box.type = "checkbox";
+        box.name = field;
+        box.id = `tag-${tag.id}`;
+        box.value = tag.id;
+        box.checked = true;
+
+        const label = document.createElement("label");
+        label.className = "form-check-label";
+        label.htmlFor = box.id;
+        label.textContent = tag.name;
+
+        span.append(box, label);
+        checked.append(span);
+    }
+
+    function show(tags) {
+        list.replaceChildren(...tags.map(tag => {
+            const item = document.createElement("li");
+            const button = document.createElement("button");
+            button.type = "button";
+            button.className = "btn btn-link";
+            button.textContent = `${tag.name} (${tag.post_count})`;
+            button.addEventListener("click", () => {
+                addTag(tag);
+                input.value = "";
+                list.replaceChildren();
+            });
+            item.append(button);
+            return item;
+        }));
+    }
+
+    input.addEventListener("input", () => {
+        clearTimeout(pending);
+
+        const prefix = input.value.trim();
+
+        if (!prefix) {
+            list.replaceChildren();
+            return;
+        }
+
+        // Wait for a pause in typing before asking
+        pending = setTimeout(async () => {
+            const response = await fetch(`${url}?prefix=${encodeURIComponent(prefix)}`);
+
+            if (response.ok && input.value.trim() === prefix) {
+                show((await response.json()).tags);
+            }
+        }, 150);
+    });
+});
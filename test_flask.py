@@ -1,65 +1,224 @@
-"""Integration test for app.py routes"""
-
-from unittest import TestCase
+"""Integration test for app.py routes
+
+Each test runs in a transaction that is rolled back afterwards, on a
+schema built once per process. The tests run on TEST_DATABASE_URL
+(sqlite:// for in-memory SQLite) and in parallel with pytest-xdist,
+which gives every worker its own database:
+
+    python -m pytest -n auto test_flask.py
+"""
+
+import json
+import os
+import tempfile
+import asyncio
+import random
+import re
+from html import unescape
+from datetime import datetime
+from unittest import TestCase, skipIf
 
 from sqlalchemy.sql.operators import as_
-from app import app
-from models import User, Post, Tag, PostTag, db
+from app import create_app
+from config import TestingConfig
+from models import User, Post, Tag, PostTag, RelatedPost, CacheVersion, db, tag_catalog
+from cache import fragment_cache, LRUCache
+from importer import import_files
+from search import search_posts
+import benchmark
+from instrumentation import metrics, QueryCounter
+from routing import RoutingSession
+from purge import purge
+from related import rebuild_related
+from sqlalchemy import create_engine, event, func, select, text
+from sqlalchemy.engine import Engine, make_url
 
-app.config["SQLALCHEMY_DATABASE_URI"] = "postgresql:///blogly_test"
-app.config["SQLALCHEMY_ECHO"] = False
+try:
+    import asgi
+except ImportError:
+    asgi = None
 
-db.app = app
+def worker_database(uri):
+    """This pytest-xdist worker's copy of the test database, e.g. blogly_test_gw1.
+    In-memory SQLite is private to each process already."""
 
-db.drop_all()
-db.create_all()
+    url = make_url(uri)
+    worker = os.environ.get("PYTEST_XDIST_WORKER")
 
-class BloglyTestCase(TestCase):
-    """test cases for user routes"""
-    
-    def setUp(self):
-        """empty tables, set up sample user and post models"""
+    if not worker or url.database in (None, "", ":memory:"):
+        return uri
 
-        db.create_all()
+    if url.get_backend_name() == "sqlite":
+        root, ext = os.path.splitext(url.database)
+        return url.set(database=f"{root}_{worker}{ext}").render_as_string(hide_password=False)
+
+    return url.set(database=f"{url.database}_{worker}").render_as_string(hide_password=False)
+
+
+def create_database(uri):
+    """Create a missing Postgres test database; SQLite creates its own"""
+
+    url = make_url(uri)
+
+    if url.get_backend_name() != "postgresql":
+        return
+
+    server = create_engine(url.set(database="postgres"), isolation_level="AUTOCOMMIT")
+
+    with server.connect() as conn:
+        exists = conn.execute(text("SELECT 1 FROM pg_database WHERE datname = :name"),
+                              {"name": url.database}).scalar()
+        if not exists:
+            conn.execute(text(f'CREATE DATABASE "{url.database}"'))
+
+    server.dispose()
+
+
+class WorkerTestingConfig(TestingConfig):
+    """TestingConfig on this worker's database"""
+
+    SQLALCHEMY_DATABASE_URI = worker_database(TestingConfig.SQLALCHEMY_DATABASE_URI)
+
+
+# Subprocesses started by the tests (benchmark.cold_start) use the same database
+os.environ["TEST_DATABASE_URL"] = WorkerTestingConfig.SQLALCHEMY_DATABASE_URI
+IN_MEMORY = make_url(WorkerTestingConfig.SQLALCHEMY_DATABASE_URI).database in (None, "", ":memory:")
+
+app = create_app(WorkerTestingConfig)
+app.app_context().push()
+
+if db.engine.dialect.name == "sqlite":
+    # Let SQLAlchemy issue BEGIN itself, so SAVEPOINTs work on pysqlite
+    @event.listens_for(db.engine, "connect")
+    def sqlite_connect(dbapi_connection, connection_record):
+        dbapi_connection.isolation_level = None
 
-        PostTag.query.delete()
-        Tag.query.delete()
-        Post.query.delete()
-        User.query.delete()
+    @event.listens_for(db.engine, "begin")
+    def sqlite_begin(conn):
+        conn.exec_driver_sql("BEGIN")
+
+# The schema is built once per worker process
+create_database(WorkerTestingConfig.SQLALCHEMY_DATABASE_URI)
+db.drop_all()
+db.create_all()
+
+SESSION = db.session
+
+
+# Most SQL statements a request to each endpoint may run. test_query_budgets
+# checks them on a dataset big enough that a per-row lazy load, say a
+# template reaching through post.user or tag.posts, goes far over.
+QUERY_BUDGETS = {
+    "blogly.home": 0,
+    "blogly.user_form": 0,
+    "blogly.new_tag": 0,
+    "blogly.metrics_endpoint": 0,
+    # One keyset page
+    "blogly.user_list": 1,
+    "blogly.list_tags": 1,
+    "blogly.export": 1,
+    "blogly.search_json": 1,
+    "blogly.edit_user_form": 1,
+    "blogly.edit_tag": 1,
+    "blogly.submit_user_form": 1,
+    "blogly.post_form": 1,
+    # The page, then the tag names of its posts
+    "blogly.post_feed": 2,
+    "blogly.tag_feed": 3,
+    # The tag catalog's version probe and reload
+    "blogly.suggest_tags": 2,
+    # Results, then the tag catalog's version probe and reload
+    "blogly.search": 3,
+    # The row, one selectin load
+    "blogly.edit_post": 2,
+    # updated_at lookup, the row, one selectin load
+    "blogly.user_profile": 3,
+    "blogly.show_tag": 3,
+    # ...and its related posts
+    "blogly.view_post": 4,
+    "blogly.submit_new_tag": 2,
+    "blogly.submit_user_edit": 4,
+    "blogly.submit_edit_tag": 5,
+    # The same statements however many posts move
+    "blogly.merge_tags": 10,
+    "blogly.post_form_submit": 11,
+    "blogly.submit_post_edit": 15,
+    "blogly.delete_user": 4,
+    "blogly.delete_post": 6,
+    "blogly.delete_tag": 3,
+    # Ten posts, but the same statements for any number
+    "blogly.create_posts_json": 11,
+}
+
+# Statements the transactional test harness adds around commits
+HARNESS_STATEMENTS = ("SAVEPOINT", "RELEASE SAVEPOINT", "ROLLBACK TO SAVEPOINT")
+
+
+def pager_link(html, label):
+    """The URL of a page's "Next" or "Previous" link, or None"""
+
+    match = re.search(f'href="([^"]*)">{label}</a>', html)
+
+    return unescape(match.group(1)) if match else None
+
+
+class BloglyFixtures(TestCase):
+    """Sample user, post and tag shared by every test"""
+
+    def add_sample_data(self):
+        fragment_cache.clear()
+        tag_catalog.invalidate()
 
         test_user = User(first_name='FIRST_NAME',
                          last_name='LAST_NAME',
                          image_url='https://unsplash.com/photos/2LowviVHZ-E')
-        
-        db.session.add(test_user)
-        db.session.commit()
+
+        test_tag = Tag(name="TAG_NAME")
 
         test_post = Post(title='TITLE',
                          content='CONTENT',
-                         user_id=test_user.id)
-
-        db.session.add(test_post)
-        db.session.commit()
+                         user=test_user,
+                         tags=[test_tag])
 
-        test_tag = Tag(name="TAG_NAME")
-        
-        db.session.add(test_tag)
+        db.session.add_all([test_user, test_tag, test_post])
         db.session.commit()
 
-        test_post_tag = PostTag(post_id=test_post.id, tag_id=test_tag.id)
-
-        db.session.add(test_post_tag)
-        db.session.commit()
-        
         self.user_id = test_user.id
         self.post_id = test_post.id
         self.tag_id = test_tag.id
 
+
+class BloglyTestCase(BloglyFixtures):
+    """test cases for user routes, each inside a transaction that is rolled back"""
+    
+    def setUp(self):
+        """open a transaction, bind the session to it and add sample data"""
+
+        self.connection = db.engine.connect()
+        self.transaction = self.connection.begin()
+        self.savepoint = self.connection.begin_nested()
+
+        # Commits in the code under test end the SAVEPOINT; start the next one
+        def restart_savepoint(session, transaction):
+            if not self.savepoint.is_active:
+                self.savepoint = self.connection.begin_nested()
+
+        self.restart_savepoint = restart_savepoint
+        event.listen(RoutingSession, "after_transaction_end", restart_savepoint)
+
+        db.session = db.create_scoped_session(options=dict(bind=self.connection, binds={}))
+
+        self.add_sample_data()
+
     def tearDown(self):
-        """rollback database"""
+        """roll back everything the test wrote"""
 
         db.session.remove()
-        db.drop_all()
+        db.session = SESSION
+        event.remove(RoutingSession, "after_transaction_end", self.restart_savepoint)
+
+        self.transaction.rollback()
+        self.connection.close()
 
     # CREATE
 
@@ -99,6 +258,111 @@ class BloglyTestCase(TestCase):
             self.assertEqual(response.status_code, 200)
             self.assertIn(f"<h1>Add Post for {user.full_name()}</h1>", html)
     
+    def test_post_form_tag_selector(self):
+        """test post forms list only the post's tags and load the rest on demand"""
+
+        db.session.add(Tag(name="UNUSED_TAG"))
+        CacheVersion.bump("tags")
+        db.session.commit()
+
+        with app.test_client() as client:
+            html = client.get(f"/users/{self.user_id}/posts/new").get_data(as_text=True)
+
+            self.assertIn("/static/tags.js", html)
+            self.assertNotIn("TAG_NAME", html)
+
+            html = client.get(f"/posts/{self.post_id}/edit").get_data(as_text=True)
+
+            self.assertIn(f'value="{self.tag_id}" checked', html)
+            self.assertNotIn("UNUSED_TAG", html)
+
+    def test_merge_tags(self):
+        """test merging tags moves their posts, dedupes links and frees the names"""
+
+        tags = [Tag(name="Python"), Tag(name="python"), Tag(name="python3")]
+        db.session.add_all(tags)
+        db.session.commit()
+        target, lower, three = [tag.id for tag in tags]
+
+        both = Post.create(self.user_id, "BOTH", "C", [target, lower])
+        only = Post.create(self.user_id, "ONLY", "C", [three])
+
+        with app.test_client() as client:
+            response = client.post(f"/tags/{target}/merge",
+                                   data={"tags": [lower, three, 999999], "tag-name": "python"},
+                                   follow_redirects=True)
+            html = response.get_data(as_text=True)
+
+            self.assertIn("python", html)
+            self.assertIn("BOTH", html)
+            self.assertIn("ONLY", html)
+
+        self.assertEqual(sorted(PostTag.query.filter_by(tag_id=target)
+                                .with_entities(PostTag.post_id)),
+                         [(both,), (only,)])
+        self.assertEqual(PostTag.query.filter(PostTag.tag_id.in_([lower, three])).count(), 0)
+        self.assertEqual([(tag.name, tag.post_count) for tag in
+                          Tag.query.filter(Tag.id.in_([target, lower, three]))],
+                         [("python", 2)])
+        self.assertIn("python", tag_catalog.get().names.values())
+
+        # Merging nothing changes nothing
+        self.assertEqual(Tag.merge(target, [target]), [])
+
+        # The new name must not belong to another live tag
+        extra = Tag(name="EXTRA")
+        db.session.add(extra)
+        db.session.commit()
+
+        with app.test_client() as client:
+            response = client.post(f"/tags/{self.tag_id}/merge",
+                                   data={"tags": [extra.id], "tag-name": "python"})
+            self.assertEqual(response.status_code, 400)
+            self.assertIn("There is already a tag named python", response.get_data(as_text=True))
+
+        result = app.test_cli_runner().invoke(args=["merge-tags", "TAG_NAME", "EXTRA",
+                                                    "--rename", "python"])
+        self.assertEqual(result.exit_code, 1)
+        self.assertIn("There is already a tag named python", result.output)
+        self.assertEqual([tag.name for tag in Tag.query.filter(Tag.id.in_([self.tag_id, extra.id]))],
+                         ["TAG_NAME", "EXTRA"])
+
+    def test_suggest_tags(self):
+        """test tag suggestions match name prefixes and rank by usage"""
+
+        tags = [Tag(name="TAG_QUIET"), Tag(name="tag_50%"), Tag(name="TAGGED")]
+        db.session.add_all(tags)
+        db.session.commit()
+
+        for tag_ids in ([tags[1].id, tags[2].id], [tags[1].id, tags[2].id], [tags[2].id]):
+            Post.create(self.user_id, "T", "C", tag_ids)
+
+        CacheVersion.bump("tags")
+        db.session.commit()
+
+        def names(source, url):
+            app.config["TAG_SUGGEST_SOURCE"] = source
+            return [tag["name"] for tag in client.get(url).get_json()["tags"]]
+
+        with app.test_client() as client:
+            try:
+                for source in ("catalog", "database"):
+                    self.assertEqual(names(source, "/tags/suggest?prefix=tag"),
+                                     ["TAGGED", "tag_50%", "TAG_NAME", "TAG_QUIET"])
+                    self.assertEqual(names(source, "/tags/suggest?prefix=Tag_&limit=2"),
+                                     ["tag_50%", "TAG_NAME"])
+                    self.assertEqual(names(source, "/tags/suggest?prefix=tag_5"), ["tag_50%"])
+                    self.assertEqual(names(source, "/tags/suggest?prefix=tag_%25"), [])
+                    self.assertEqual(names(source, "/tags/suggest?prefix=nope"), [])
+                    self.assertEqual(names(source, "/tags/suggest?prefix="), [])
+
+                # Creating a tag through the form refreshes the catalog
+                client.post("/tags/new", data={"tag-name": "tagline"})
+
+                self.assertIn("tagline", names("catalog", "/tags/suggest?prefix=tagl"))
+            finally:
+                app.config["TAG_SUGGEST_SOURCE"] = "catalog"
+
     def test_post_form_submit(self):
         """test new post submission"""
 
@@ -113,7 +377,83 @@ class BloglyTestCase(TestCase):
 
             self.assertEqual(response.status_code, 200)
             self.assertIn("TITLE", html)
-    
+
+    def test_post_form_submit_deleted_user(self):
+        """test posts can't be added for a missing or deleted user"""
+
+        User.remove_user(self.user_id)
+
+        with app.test_client() as client:
+            for id in (self.user_id, 999999):
+                response = client.post(f"/users/{id}/posts/new",
+                                       data={"title": "ORPHAN", "content": "C"})
+
+                self.assertIn("404 Not Found", response.get_data(as_text=True))
+
+        self.assertEqual(db.session.execute(
+            select(func.count(Post.id)).where(Post.title == "ORPHAN")
+            .execution_options(include_deleted=True)).scalar(), 0)
+
+    def test_post_form_submit_with_tags(self):
+        """test new post and its tag links are written in one commit"""
+
+        commits = []
+        record = lambda session: commits.append(session)
+        db.event.listen(RoutingSession, "after_commit", record)
+
+        with app.test_client() as client:
+            data = {"title": "TAGGED", "content": "CONTENT", "tags": [str(self.tag_id)]}
+            client.post(f"/users/{self.user_id}/posts/new", data=data)
+
+        db.event.remove(RoutingSession, "after_commit", record)
+
+        post = Post.query.filter_by(title="TAGGED").one()
+
+        self.assertEqual(len(commits), 1)
+        self.assertEqual([tag.id for tag in post.tags], [self.tag_id])
+
+    def test_create_posts_json(self):
+        """test batch post creation and its per-item errors"""
+
+        with app.test_client() as client:
+            good = {"user_id": self.user_id, "title": "BATCH", "content": "C", "tags": [self.tag_id]}
+
+            response = client.post("/api/posts", json={"posts": [good, dict(good, tags=[])]})
+
+            self.assertEqual(response.status_code, 201)
+            self.assertEqual(len(response.json["ids"]), 2)
+            self.assertEqual(PostTag.query.filter_by(tag_id=self.tag_id).count(), 2)
+
+            response = client.post("/api/posts", json={"posts": [
+                good,
+                dict(good, title=" "),
+                dict(good, user_id=999999, tags=[999999]),
+                "not a post"]})
+
+            self.assertEqual(response.status_code, 422)
+            self.assertEqual(response.json["errors"], [
+                {"index": 1, "errors": {"title": "must be a non-empty string"}},
+                {"index": 2, "errors": {"user_id": "no user 999999", "tags": "no tags [999999]"}},
+                {"index": 3, "errors": {"item": "must be an object"}}])
+            self.assertEqual(Post.query.filter_by(title="BATCH").count(), 2)
+
+            self.assertEqual(client.post("/api/posts", json=[good]).status_code, 400)
+
+            # One statement inserts the posts whatever their number, and the ids match
+            counts = []
+
+            for size in (1, 20):
+                posts = [dict(good, title=f"SIZED_{size}_{n}") for n in range(size)]
+
+                with QueryCounter(db.engine) as queries:
+                    ids = client.post("/api/posts", json={"posts": posts}).json["ids"]
+
+                counts.append(queries.count)
+                self.assertEqual([Post.query.get(id).title for id in ids],
+                                 [post["title"] for post in posts])
+
+            self.assertEqual(counts[0], counts[1])
+
     def test_new_tag(self):
         """test new tag form display"""
 
@@ -155,7 +495,41 @@ class BloglyTestCase(TestCase):
             self.assertEqual(response.status_code, 200)
             self.assertIn('<h1>Users</h1>', html)
             self.assertIn('FIRST_NAME LAST_NAME', html)
-    
+
+    def test_user_list_pagination(self):
+        """test user list keyset pagination"""
+
+        db.session.add_all([User(first_name=f"USER_{n}", last_name="ZZZ", image_url="")
+                            for n in range(3)])
+        db.session.commit()
+
+        with app.test_client() as client:
+            first = client.get('/users?per_page=2')
+            page = first.get_data(as_text=True)
+
+            self.assertIn('FIRST_NAME LAST_NAME', page)
+            self.assertIn('USER_0 ZZZ', page)
+            self.assertNotIn('USER_1 ZZZ', page)
+
+            # The page links keep per_page
+            self.assertIsNone(pager_link(page, "Previous"))
+            page = client.get(pager_link(page, "Next")).get_data(as_text=True)
+
+            self.assertIn('USER_1 ZZZ', page)
+            self.assertIn('USER_2 ZZZ', page)
+            self.assertNotIn('USER_0 ZZZ', page)
+            self.assertIsNone(pager_link(page, "Next"))
+            self.assertIn("per_page=2", pager_link(page, "Previous"))
+
+            back = client.get(pager_link(page, "Previous"))
+
+            self.assertIn('USER_0 ZZZ', back.get_data(as_text=True))
+
+            # Not base64 JSON; lists instead of values; not a list
+            for cursor in ['not-a-cursor', 'W1tdLFtdLFtdXQ', 'eyJhIjogMX0']:
+                bad = client.get(f'/users?after={cursor}')
+                self.assertIn('Invalid page cursor', bad.get_data(as_text=True), cursor)
+
     def test_user_profile(self):
         """test user profile display"""
         with app.test_client() as client:
@@ -178,6 +552,302 @@ class BloglyTestCase(TestCase):
             self.assertIn("TITLE", html)
             self.assertIn("CONTENT", html)
 
+    def test_related_posts(self):
+        """test related posts rank by shared tags, rarest first, and follow edits"""
+
+        rare, common, other = Tag(name="RARE"), Tag(name="COMMON"), Tag(name="OTHER")
+        db.session.add_all([rare, common, other])
+        db.session.commit()
+
+        tags = {"BOTH": [rare.id, common.id], "RARE_ONLY": [rare.id],
+                "COMMON_ONLY": [common.id], "TWO_COMMON": [common.id],
+                "UNRELATED": [other.id], "ALSO_UNRELATED": [other.id]}
+        ids = {title: Post.create(self.user_id, title, "C", tag_ids)
+               for title, tag_ids in tags.items()}
+        titles = {id: title for title, id in ids.items()}
+
+        def related(title):
+            return [titles.get(id, id) for id, _ in RelatedPost.for_post(ids[title])]
+
+        self.assertEqual(rebuild_related(top=2, max_tag_share=1), 6)
+        self.assertEqual(related("BOTH"), ["RARE_ONLY", "TWO_COMMON"])
+        self.assertEqual(related("RARE_ONLY"), ["BOTH"])
+        self.assertEqual(related("UNRELATED"), ["ALSO_UNRELATED"])
+        self.assertEqual(rebuild_related(top=2, max_tag_share=1), 0)
+
+        with app.test_client() as client:
+            html = client.get(f"/posts/{ids['RARE_ONLY']}").get_data(as_text=True)
+
+            self.assertIn("Related posts", html)
+            self.assertIn(f'href="/posts/{ids["BOTH"]}">BOTH', html)
+
+        PostTag.update_tags(ids["UNRELATED"], [])
+        Post.remove_post(ids["RARE_ONLY"])
+
+        self.assertEqual(rebuild_related(top=2, max_tag_share=1), 4)
+        self.assertEqual(related("BOTH"), ["TWO_COMMON", "COMMON_ONLY"])
+        self.assertEqual(related("ALSO_UNRELATED"), [])
+
+        # COMMON is now on 3 of the 5 tagged posts
+        rebuild_related(top=2, max_tag_share=0.5)
+        self.assertEqual(related("BOTH"), [])
+
+        purge(pause=0)
+
+        self.assertFalse(RelatedPost.query.filter_by(related_id=ids["RARE_ONLY"]).count())
+
+    def test_related_posts_follow_their_posts(self):
+        """test a post page changes when a post it lists as related is renamed or deleted"""
+
+        shared, other = Tag(name="SHARED"), Tag(name="OTHER")
+        db.session.add_all([shared, other])
+        db.session.commit()
+
+        ids = {title: Post.create(self.user_id, title, "C", [tag.id])
+               for title, tag in [("A", shared), ("B", shared), ("C", shared), ("D", other)]}
+        rebuild_related(top=2, max_tag_share=1)
+
+        with app.test_client() as client:
+            page = f"/posts/{ids['A']}"
+            response = client.get(page)
+            self.assertIn(f'href="/posts/{ids["B"]}">B<', response.get_data(as_text=True))
+
+            Post.query.get(ids["B"]).update("RENAMED", None)
+
+            renamed = client.get(page, headers={"If-None-Match": response.headers["ETag"]})
+            self.assertEqual(renamed.status_code, 200)
+            self.assertIn(f'href="/posts/{ids["B"]}">RENAMED<', renamed.get_data(as_text=True))
+
+            Post.remove_post(ids["C"])
+
+            removed = client.get(page, headers={"If-None-Match": renamed.headers["ETag"]})
+            self.assertEqual(removed.status_code, 200)
+            self.assertNotIn(f'href="/posts/{ids["C"]}"', removed.get_data(as_text=True))
+
+    def test_rendered_content(self):
+        """test post content is rendered and sanitized on write and backfilled"""
+
+        with app.test_client() as client:
+            data = {"title": "MARKDOWN", "content": "**bold** <script>alert(1)</script>"}
+            client.post(f"/users/{self.user_id}/posts/new", data=data)
+            post = Post.query.filter_by(title="MARKDOWN").one()
+
+            html = client.get(f"/posts/{post.id}").get_data(as_text=True)
+
+            self.assertIn("<strong>bold</strong>", html)
+            self.assertNotIn("<script>", html)
+
+            # setUp's post was written without rendering
+            result = app.test_cli_runner().invoke(args=["render-posts", "--workers", "2"])
+
+            self.assertIn("Rendered 1 posts", result.output)
+            self.assertEqual(Post.render_stale(), 0)
+
+            html = client.get(f"/posts/{self.post_id}").get_data(as_text=True)
+            self.assertIn("<p>CONTENT</p>", html)
+
+    def test_view_post_cache_invalidation(self):
+        """test cached post, profile and tag pages are refreshed after an edit"""
+
+        with app.test_client() as client:
+            pages = [f"/posts/{self.post_id}", f"/users/{self.user_id}", f"/tags/{self.tag_id}"]
+
+            for page in pages:
+                client.get(page)
+
+            Post.query.get(self.post_id).update("CACHED_TITLE", None)
+
+            for page in pages:
+                self.assertIn("CACHED_TITLE", client.get(page).get_data(as_text=True))
+
+    def test_conditional_get(self):
+        """test post, profile and tag pages answer revalidation with 304 until they change"""
+
+        with app.test_client() as client:
+            pages = [f"/posts/{self.post_id}", f"/users/{self.user_id}", f"/tags/{self.tag_id}"]
+            etags = {}
+
+            for page in pages:
+                response = client.get(page)
+                etags[page] = response.headers["ETag"]
+                last_modified = response.headers["Last-Modified"]
+
+                with QueryCounter(db.engine) as queries:
+                    response = client.get(page, headers={"If-None-Match": etags[page]})
+
+                self.assertEqual(response.status_code, 304)
+                self.assertEqual(queries.count, 1)
+
+                response = client.get(page, headers={"If-Modified-Since": last_modified})
+                self.assertEqual(response.status_code, 304)
+
+            # Renaming the tag changes the tag page and the post page listing it
+            Tag.query.get(self.tag_id).update("RENAMED_TAG")
+
+            for page in pages:
+                response = client.get(page, headers={"If-None-Match": etags[page]})
+                changed = page != f"/users/{self.user_id}"
+
+                self.assertEqual(response.status_code, 200 if changed else 304)
+
+            # Renaming the author changes the profile and the post page naming them
+            etags = {page: client.get(page).headers["ETag"] for page in pages}
+            User.query.get(self.user_id).update("RENAMED", None, None)
+
+            for page in pages:
+                response = client.get(page, headers={"If-None-Match": etags[page]})
+                changed = page != f"/tags/{self.tag_id}"
+
+                self.assertEqual(response.status_code, 200 if changed else 304)
+
+    def test_lru_cache_bounds(self):
+        """test fragment cache evicts least recently used and expired entries"""
+
+        cache = LRUCache(maxsize=2, ttl=300)
+        cache.set("a", "A")
+        cache.set("b", "B")
+        cache.get("a")
+        cache.set("c", "C")
+
+        self.assertEqual([cache.get(k) for k in "abc"], ["A", None, "C"])
+
+        expired = LRUCache(maxsize=2, ttl=-1)
+        expired.set("a", "A")
+
+        self.assertIsNone(expired.get("a"))
+
+    def test_search(self):
+        """test ranked full-text search with snippets and tag filter"""
+
+        with app.test_client() as client:
+            for title in ["Giraffe facts", "Zoo trip"]:
+                client.post(f"/users/{self.user_id}/posts/new",
+                            data={"title": title, "content": "a giraffe <b>at</b> the zoo"})
+
+            client.post(f"/posts/{self.post_id}/edit",
+                        data={"title": "Old giraffe", "content": "CONTENT", "tags": [self.tag_id]})
+
+            html = client.get("/search?q=giraffe").get_data(as_text=True)
+
+            self.assertIn("Giraffe facts", html)
+            self.assertIn("Old giraffe", html)
+            self.assertIn("<mark>giraffe</mark>", html)
+            self.assertIn("&lt;b&gt;at&lt;/b&gt;", html)
+
+            self.assertNotIn("TAG_NAME", html)
+
+            html = client.get(f"/search?q=giraffe&tag={self.tag_id}").get_data(as_text=True)
+            self.assertIn(f'name="tag" id="tag-{self.tag_id}"\n        value="{self.tag_id}" checked', html)
+            self.assertIn('data-field="tag"', html)
+
+            filtered = client.get(f"/api/search?q=giraffe&tag={self.tag_id}").json
+            self.assertEqual([hit["id"] for hit in filtered["results"]], [self.post_id])
+
+            first = client.get("/api/search?q=giraffe&per_page=2").json
+            rest = client.get(f"/api/search?q=giraffe&per_page=2&after={first['next']}").json
+            self.assertEqual(len(first["results"]) + len(rest["results"]), 3)
+            self.assertIsNone(rest["next"])
+
+            # Title matches rank above content-only matches
+            self.assertEqual(rest["results"][0]["title"], "Zoo trip")
+
+            Post.remove_post(self.post_id)
+            after_delete = client.get("/api/search?q=giraffe").json
+            self.assertNotIn(self.post_id, [hit["id"] for hit in after_delete["results"]])
+
+    def test_export(self):
+        """test streaming NDJSON and CSV exports with filters"""
+
+        with app.test_client() as client:
+            response = client.get(f"/export/posts.ndjson?user_id={self.user_id}")
+            rows = [json.loads(line) for line in response.get_data(as_text=True).splitlines()]
+
+            self.assertEqual(response.mimetype, "application/x-ndjson")
+            self.assertEqual([row["title"] for row in rows], ["TITLE"])
+
+            response = client.get("/export/post_tags.csv")
+            lines = response.get_data(as_text=True).splitlines()
+
+            self.assertEqual(lines, ["post_id,tag_id,tag", f"{self.post_id},{self.tag_id},TAG_NAME"])
+
+            response = client.get("/export/posts.ndjson?since=2999-01-01")
+            self.assertEqual(response.get_data(as_text=True), "")
+
+    def test_import_files(self):
+        """test bulk import is idempotent and indexes imported posts"""
+
+        with tempfile.TemporaryDirectory() as tmp:
+            users = os.path.join(tmp, "users.ndjson")
+            posts = os.path.join(tmp, "posts.csv")
+            post_tags = os.path.join(tmp, "post_tags.ndjson")
+
+            with open(users, "w") as file:
+                file.write(json.dumps(dict(id=100, first_name="IMPORTED", last_name="USER",
+                                           image_url="")) + "\n")
+
+            with open(posts, "w") as file:
+                file.write("id,user_id,title,content,created_at\n"
+                           "100,100,Imported walrus,Body,2021-08-30T15:37:16\n"
+                           "101,100,Second import,Body,\n")
+
+            with open(post_tags, "w") as file:
+                for link in [dict(post_id=100, tag="TAG_NAME"), dict(post_id=100, tag="IMPORTED_TAG"),
+                             dict(post_id=999, tag="IMPORTED_TAG"), dict(post_id=100, tag=""),
+                             dict(post_id=100)]:
+                    file.write(json.dumps(link) + "\n")
+
+            paths = dict(users=users, posts=posts, post_tags=post_tags)
+            import_files(paths, batch_size=1)
+            import_files(paths, batch_size=1)
+
+        self.assertEqual(User.query.count(), 2)
+        self.assertEqual(Post.query.filter_by(user_id=100).count(), 2)
+        self.assertEqual(sorted(tag.name for tag in Post.query.get(100).tags),
+                         ["IMPORTED_TAG", "TAG_NAME"])
+        self.assertEqual(Tag.query.filter_by(name="IMPORTED_TAG").count(), 1)
+        self.assertEqual([hit.id for hit in search_posts(db.session, "walrus")], [100])
+
+    def test_benchmark(self):
+        """test benchmark dataset generation, route metrics and regression check"""
+
+        counts = benchmark.generate(users=5, posts=30, tags=4)
+        self.assertEqual(counts["posts"], 30)
+        self.assertEqual(Post.query.count(), 31)
+
+        with app.app_context():
+            results = benchmark.run(requests=3)
+
+        self.assertEqual(set(results), {route.name for route in benchmark.ROUTES})
+        self.assertGreater(results["view_post"]["queries"], 0)
+
+        baseline = {"view_post": dict(results["view_post"], queries=0)}
+        self.assertEqual(len(benchmark.compare(results, baseline)), 1)
+        self.assertEqual(benchmark.compare(results, results), [])
+
+    def test_query_budgets(self):
+        """test every endpoint stays within its SQL statement budget on a big dataset"""
+
+        benchmark.generate(users=20, posts=400, tags=40)
+        sample = benchmark.Sample(random.Random(0))
+        urls = app.url_map.bind("localhost")
+        counted, over = set(), []
+
+        with app.test_client() as client:
+            for route in benchmark.ROUTES:
+                response, _, statements = benchmark.call(client, route, sample)
+                endpoint, _ = urls.match(response.request.path, route.method)
+                statements = [sql for sql in statements if not sql.startswith(HARNESS_STATEMENTS)]
+                counted.add(endpoint)
+
+                if len(statements) > QUERY_BUDGETS.get(endpoint, 0):
+                    over.append(f"{route.name}: {len(statements)} statements, budget "
+                                f"{QUERY_BUDGETS.get(endpoint, 0)}\n  " + "\n  ".join(statements))
+        self.assertEqual(set(counted), {endpoint for endpoint in app.view_functions
+                                        if endpoint.startswith("blogly.")})
+
+        if over:
+            self.fail("\n".join(over))
+
     def test_list_tags(self):
         """test tag list display"""
         with app.test_client() as client:
@@ -187,6 +857,144 @@ class BloglyTestCase(TestCase):
             self.assertEqual(response.status_code, 200)
             self.assertIn("TAG_NAME", html)
 
+    def test_list_tags_pagination(self):
+        """test tag list keyset pagination"""
+
+        db.session.add_all([Tag(name=f"ZZ_TAG_{n}") for n in range(3)])
+        CacheVersion.bump("tags")
+        db.session.commit()
+
+        with app.test_client() as client:
+            page = client.get("/tags?per_page=2").get_data(as_text=True)
+
+            self.assertIn("TAG_NAME", page)
+            self.assertIn("ZZ_TAG_0", page)
+            self.assertNotIn("ZZ_TAG_1", page)
+
+            page = client.get(pager_link(page, "Next")).get_data(as_text=True)
+
+            self.assertIn("ZZ_TAG_2", page)
+            self.assertNotIn("ZZ_TAG_0", page)
+            self.assertIsNone(pager_link(page, "Next"))
+
+            page = client.get(pager_link(page, "Previous")).get_data(as_text=True)
+
+            self.assertIn("TAG_NAME", page)
+            self.assertIn("ZZ_TAG_0", page)
+            self.assertIsNone(pager_link(page, "Previous"))
+
+            # Sort order and page size carry over, the old cursor doesn't
+            page = client.get("/tags?sort=posts&per_page=1").get_data(as_text=True)
+            self.assertEqual(pager_link(page, "Next").split("&after=")[0],
+                             "/tags?sort=posts&per_page=1")
+
+            page = client.get(pager_link(page, "Next")).get_data(as_text=True)
+            self.assertEqual(pager_link(page, "Next").count("after="), 1)
+            self.assertNotIn("after=", pager_link(page, "Previous"))
+
+    def test_post_counts(self):
+        """test user and tag post counts follow every write path and sort the lists"""
+
+        # setUp adds its post directly, so the counters start out drifted
+        self.assertEqual(User.reconcile_post_counts(), 1)
+        self.assertEqual(Tag.reconcile_post_counts(), 1)
+        db.session.commit()
+
+        other = Tag(name="OTHER_TAG")
+        quiet = User(first_name="QUIET", last_name="USER", image_url="")
+        db.session.add_all([other, quiet])
+        db.session.commit()
+        other_id, quiet_id = other.id, quiet.id
+
+        def counts():
+            db.session.expire_all()
+            return ([User.query.get(id).post_count for id in (self.user_id, quiet_id)],
+                    [Tag.query.get(id).post_count for id in (self.tag_id, other_id)])
+
+        with app.test_client() as client:
+            data = {"title": "COUNTED", "content": "C", "tags": [self.tag_id, other_id]}
+            client.post(f"/users/{self.user_id}/posts/new", data=data)
+            self.assertEqual(counts(), ([2, 0], [2, 1]))
+
+            html = client.get("/users?sort=posts").get_data(as_text=True)
+            self.assertLess(html.index("FIRST_NAME LAST_NAME</a> (2)"), html.index("QUIET USER</a> (0)"))
+
+            html = client.get("/tags?sort=posts").get_data(as_text=True)
+            self.assertLess(html.index("TAG_NAME</a> (2)"), html.index("OTHER_TAG</a> (1)"))
+
+            post_id = Post.query.filter_by(title="COUNTED").one().id
+            PostTag.update_tags(post_id, [other_id])
+            self.assertEqual(counts(), ([2, 0], [1, 1]))
+
+            client.post(f"/posts/{post_id}/delete")
+            self.assertEqual(counts(), ([1, 0], [1, 0]))
+
+            client.post(f"/users/{self.user_id}/delete")
+            db.session.expire_all()
+            self.assertEqual([Tag.query.get(id).post_count for id in (self.tag_id, other_id)],
+                             [0, 0])
+
+        self.assertEqual(User.reconcile_post_counts(), 0)
+        self.assertEqual(Tag.reconcile_post_counts(), 0)
+
+    def test_deleted_tags_gain_and_lose_no_posts(self):
+        """test editing and adding posts leave the links and counts of deleted tags alone"""
+
+        Tag.remove_tag(self.tag_id)
+
+        def dead_tag():
+            db.session.expire_all()
+            count = (db.session.query(Tag.post_count).filter(Tag.id == self.tag_id)
+                     .execution_options(include_deleted=True).scalar())
+            return count, PostTag.query.filter_by(tag_id=self.tag_id).count()
+
+        self.assertEqual(dead_tag(), (0, 1))
+
+        with app.test_client() as client:
+            client.post(f"/posts/{self.post_id}/edit",
+                        data={"title": "", "content": "", "tags": []})
+            self.assertEqual(dead_tag(), (0, 1))
+
+            client.post(f"/users/{self.user_id}/posts/new",
+                        data={"title": "T", "content": "C", "tags": [self.tag_id]})
+            self.assertEqual(dead_tag(), (0, 1))
+
+    def test_post_feed(self):
+        """test the feeds page newest first, break ties on id and filter by tag"""
+
+        same_time = datetime(2021, 6, 1)
+        posts = [Post(title=f"FEED_{n}", content="C", user_id=self.user_id,
+                      created_at=datetime(2021, 1, 1 + n) if n < 3 else same_time)
+                 for n in range(5)]
+        db.session.add_all(posts)
+        db.session.commit()
+        db.session.add(PostTag(post_id=posts[1].id, tag_id=self.tag_id))
+        db.session.commit()
+
+        def titles(html):
+            shown = [title for title in ["TITLE"] + [f"FEED_{n}" for n in range(5)]
+                     if f">{title}</a>" in html]
+            return sorted(shown, key=lambda title: html.index(f">{title}</a>"))
+
+        with app.test_client() as client:
+            url, seen = "/posts?per_page=2", []
+
+            while url:
+                html = client.get(url).get_data(as_text=True)
+                seen.append(titles(html))
+                url = pager_link(html, "Next")
+
+            # setUp's post was created just now; FEED_4 wins the tie on id
+            self.assertEqual(seen, [["TITLE", "FEED_4"], ["FEED_3", "FEED_2"], ["FEED_1", "FEED_0"]])
+            self.assertIn("FIRST_NAME LAST_NAME", html)
+            self.assertIn("before=", html)
+
+            html = client.get(f"/tags/{self.tag_id}/posts").get_data(as_text=True)
+            self.assertEqual(titles(html), ["TITLE", "FEED_1"])
+            self.assertIn(">TAG_NAME</a>", html)
+
+            self.assertIn("404 Not Found", client.get("/tags/0/posts").get_data(as_text=True))
+
     def test_show_tag(self):
         """test tag details page display"""
         with app.test_client() as client:
@@ -197,6 +1005,23 @@ class BloglyTestCase(TestCase):
             self.assertIn("TAG_NAME", html)
             self.assertIn("TITLE", html)
 
+    def test_metrics(self):
+        """test Server-Timing header and Prometheus histograms"""
+
+        metrics.reset()
+
+        with app.test_client() as client:
+            response = client.get(f"/posts/{self.post_id}")
+
+            self.assertRegex(response.headers["Server-Timing"],
+                             r'^db;dur=[\d.]+;desc="\d+ queries", render;dur=[\d.]+, total;dur=[\d.]+$')
+
+            text = client.get("/metrics").get_data(as_text=True)
+
+            self.assertIn("# TYPE blogly_request_duration_seconds histogram", text)
+            self.assertIn('blogly_request_duration_seconds_count{endpoint="blogly.view_post"} 1', text)
+            self.assertIn('blogly_db_statements_bucket{endpoint="blogly.view_post",le="+Inf"} 1', text)
+
     # UPDATE
 
     def test_edit_user_form(self):
@@ -253,6 +1078,20 @@ class BloglyTestCase(TestCase):
             self.assertIn("EDITED_TITLE", html)
             self.assertIn("EDITED_CONTENT", html)
 
+    def test_update_tags(self):
+        """test post tag update applies only the changed links"""
+
+        new_tag = Tag(name="NEW_TAG")
+        db.session.add(new_tag)
+        db.session.commit()
+
+        PostTag.update_tags(self.post_id, [str(new_tag.id), str(self.tag_id)])
+        PostTag.update_tags(self.post_id, [str(new_tag.id)])
+        PostTag.update_tags(self.post_id, [str(new_tag.id)])
+
+        tag_ids = [pt.tag_id for pt in PostTag.query.filter_by(post_id=self.post_id)]
+        self.assertEqual(tag_ids, [new_tag.id])
+
     def test_edit_tag(self):
         """test tag edit form display"""
         with app.test_client() as client:
@@ -288,6 +1127,43 @@ class BloglyTestCase(TestCase):
             self.assertNotIn('FIRST_NAME LAST_NAME', html)
             self.assertIsNone(Post.query.filter_by(user_id=self.user_id).one_or_none())
 
+    def test_delete_user_removes_post_tags(self):
+        """test user deletion removes every post and tag link of a prolific author"""
+
+        tag = Tag.query.get(self.tag_id)
+        db.session.add_all([Post(title=f"POST_{n}", content="CONTENT",
+                                 user_id=self.user_id, tags=[tag])
+                            for n in range(5)])
+        db.session.commit()
+
+        User.remove_user(self.user_id)
+
+        self.assertEqual(Post.query.count(), 0)
+        self.assertIsNotNone(Tag.query.get(self.tag_id))
+
+        # Links and rows go with the purge, a few per transaction
+        self.assertEqual(purge(batch_size=2, pause=0),
+                         dict(posts=6, tags=0, users=1, post_tag=6))
+        self.assertEqual(PostTag.query.count(), 0)
+        self.assertEqual(db.session.execute(
+            select(func.count(Post.id)).execution_options(include_deleted=True)).scalar(), 0)
+
+    def test_soft_delete_tag(self):
+        """test a deleted tag disappears from reads at once and frees its name"""
+
+        with app.test_client() as client:
+            client.post(f"/tags/{self.tag_id}/delete")
+
+            html = client.get(f"/posts/{self.post_id}").get_data(as_text=True)
+            self.assertNotIn("TAG_NAME", html)
+            self.assertEqual(PostTag.query.count(), 1)
+
+            db.session.add(Tag(name="TAG_NAME"))
+            db.session.commit()
+
+            self.assertEqual(purge(pause=0)["post_tag"], 1)
+            self.assertEqual([tag.name for tag in Tag.query], ["TAG_NAME"])
+
     def test_delete_post(self):
         """test post deletion route"""
 
@@ -320,6 +1196,157 @@ class BloglyTestCase(TestCase):
             self.assertIsNone(deleted_tag)
 
 
+@skipIf(IN_MEMORY, "other connections and processes cannot see an in-memory database")
+class CommittedTestCase(BloglyFixtures):
+    """test cases that read through other connections, apps or processes, so
+    their data has to be committed; the tables are rebuilt after each"""
+
+    def setUp(self):
+        self.add_sample_data()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        db.create_all()
+
+    def test_app_factory(self):
+        """test profiles, no SQL while building the app and the cold start timer"""
+
+        with QueryCounter(Engine) as queries:
+            production = create_app("production")
+
+        self.assertEqual(queries.count, 0)
+        self.assertFalse(production.config["SQLALCHEMY_ECHO"])
+        self.assertNotIn("debugtoolbar", production.blueprints)
+        self.assertTrue(create_app("development").config["SQLALCHEMY_ECHO"])
+        self.assertIn("init-db", production.cli.list_commands(None))
+
+        result = benchmark.cold_start("testing", runs=1)
+        self.assertEqual(result["status"], 200)
+        self.assertGreater(result["first_request_ms"], 0)
+
+    def test_cached_page_follows_other_writers(self):
+        """test a page written by another process or session is re-rendered,
+        though nothing invalidated this process's fragment cache"""
+
+        paths = [f"/posts/{self.post_id}", f"/users/{self.user_id}", f"/tags/{self.tag_id}"]
+
+        with app.test_client() as client:
+            before = [client.get(path) for path in paths]
+
+            # Another worker edits the post and touches every page that shows it
+            db.session.remove()
+            other = create_engine(app.config["SQLALCHEMY_DATABASE_URI"])
+            with other.begin() as connection:
+                connection.execute(text("UPDATE posts SET title = 'EDITED' WHERE id = :id"),
+                                   dict(id=self.post_id))
+                for table in ("posts", "users", "tags"):
+                    connection.execute(text(f"UPDATE {table} SET updated_at = :now"),
+                                       dict(now=datetime.utcnow()))
+            other.dispose()
+
+            for path, response in zip(paths, before):
+                self.assertNotIn("EDITED", response.get_data(as_text=True), path)
+
+                after = client.get(path, headers={"If-None-Match": response.headers["ETag"]})
+
+                self.assertEqual(after.status_code, 200, path)
+                self.assertNotEqual(after.headers["ETag"], response.headers["ETag"], path)
+                self.assertIn("EDITED", after.get_data(as_text=True), path)
+
+    def test_replica_routing(self):
+        """test GETs read from a replica, writes go to the primary and the
+        writer reads its own writes"""
+
+        with tempfile.TemporaryDirectory() as tmp:
+            class ReplicaConfig(WorkerTestingConfig):
+                SQLALCHEMY_REPLICA_URIS = [f"sqlite:///{tmp}/replica.db"]
+
+            replica_app = create_app(ReplicaConfig)
+            db.session.remove()
+
+            with replica_app.app_context():
+                db.Model.metadata.create_all(db.get_engine(replica_app, "replica_0"))
+                db.session.remove()
+
+            replica = db.get_engine(replica_app, "replica_0")
+            with replica.begin() as conn:
+                conn.execute(User.__table__.insert(),
+                             dict(first_name="REPLICA", last_name="USER", image_url=""))
+
+            with replica_app.test_client() as client:
+                html = client.get("/users").get_data(as_text=True)
+
+                self.assertIn("REPLICA USER", html)
+                self.assertNotIn("FIRST_NAME LAST_NAME", html)
+
+                data = {"first-name": "NEW", "last-name": "WRITER", "img-url": ""}
+                html = client.post("/users/new", data=data,
+                                   follow_redirects=True).get_data(as_text=True)
+
+                self.assertIn("NEW WRITER", html)
+                self.assertNotIn("REPLICA USER", html)
+
+                client.delete_cookie("localhost", "blogly_primary")
+                html = client.get("/users").get_data(as_text=True)
+
+                self.assertIn("REPLICA USER", html)
+
+            replica.dispose()
+
+        self.assertEqual(User.query.filter_by(last_name="WRITER").count(), 1)
+
+    @skipIf(asgi is None, "async drivers and asgiref are not installed")
+    def test_async_routes(self):
+        """test async read routes render the same pages and status codes as the sync routes"""
+
+        paths = ["/users", "/users?per_page=1", "/users?after=not-a-cursor", "/tags?sort=posts",
+                 f"/users/{self.user_id}", f"/posts/{self.post_id}", "/tags",
+                 f"/tags/{self.tag_id}", "/posts/999999", "/users/new"]
+
+        async def fetch_all(paths, headers=()):
+            blogly = asgi.AsyncBlogly(app)
+            try:
+                return [await asgi.request(blogly, path, headers) for path in paths]
+            finally:
+                await blogly.dispose()
+
+        filler = Tag(name="FILLER")
+        db.session.add(filler)
+        db.session.commit()
+
+        other = Post.create(self.user_id, "OTHER_POST", "C", [self.tag_id])
+        for _ in range(2):
+            Post.create(self.user_id, "FILLER_POST", "C", [filler.id])
+        rebuild_related()
+
+        # The async app renders first, so its pages fill the shared cache
+        fragment_cache.clear()
+        replies = asyncio.run(fetch_all(paths))
+
+        with app.test_client() as client:
+            expected = [client.get(path) for path in paths]
+
+        self.assertIn(f'href="/posts/{other}">OTHER_POST',
+                      replies[paths.index(f"/posts/{self.post_id}")][2])
+
+        fragment_cache.clear()
+
+        with app.test_client() as client:
+            self.assertEqual([client.get(path).get_data(as_text=True) for path in paths],
+                             [response.get_data(as_text=True) for response in expected])
+
+        for path, response, (status, headers, body) in zip(paths, expected, replies):
+            self.assertEqual(status, response.status_code, path)
+            self.assertEqual(body, response.get_data(as_text=True), path)
+            self.assertEqual(headers.get("etag"), response.headers.get("ETag"), path)
 
+        post = f"/posts/{self.post_id}"
+        etag = expected[paths.index(post)].headers["ETag"]
+        [(status, _, body)] = asyncio.run(fetch_all([post], [("If-None-Match", etag)]))
 
+        self.assertEqual(status, 304)
+        self.assertEqual(body, "")
 
+        rates = benchmark.throughput(requests=20, connections=2, concurrency=4)
+        self.assertGreater(rates["async"], 0)